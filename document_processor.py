@@ -1,20 +1,75 @@
 # Document Processor - Handles downloading and text extraction from various formats
 
-import aiohttp
-import hashlib
+import asyncio
+import httpx
+import multiprocessing
+from blake3 import blake3
+import os
+import shutil
+import subprocess
+import tempfile
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
 from io import BytesIO
-import PyPDF2
-import docx
-import mammoth
-from bs4 import BeautifulSoup
-import ebooklib
-from ebooklib import epub
-from striprtf.striprtf import rtf_to_text
-from pptx import Presentation
-from openpyxl import load_workbook
-import xlrd
 import re
+import html
+import posixpath
+import zipfile
+from xml.etree import ElementTree
+
+
+# Format backends (PyMuPDF, mammoth, ebooklib, ...) are imported inside the
+# extractor that needs them, so startup doesn't pay for formats never seen
+
+# Archive member names that identify ZIP-based formats, in group order
+_RE_ZIP_MARKER = re.compile(rb'(word/)|(ppt/)|(xl/)|(application/epub\+zip|META-INF/container)')
+_ZIP_MARKER_FORMATS = ('docx', 'pptx', 'xlsx', 'epub')
+
+_RE_HTML_TAG = re.compile(rb'<html', re.IGNORECASE)
+
+# DrawingML text inside slide parts: paragraphs and the text runs within them
+_RE_PPTX_SLIDE_NAME = re.compile(r'ppt/slides/slide(\d+)\.xml')
+_PPTX_SLIDE_ID = '{http://schemas.openxmlformats.org/presentationml/2006/main}sldId'
+_PPTX_SLIDE_REL_ID = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}id'
+_OPC_RELATIONSHIP = '{http://schemas.openxmlformats.org/package/2006/relationships}Relationship'
+_RE_PPTX_PARAGRAPH = re.compile(rb'<a:p(?:\s[^>]*)?>(.*?)</a:p>', re.DOTALL)
+_RE_PPTX_TEXT_RUN = re.compile(rb'<a:t(?:\s[^>]*)?>([^<]*)</a:t>')
+
+# Banner unrtf prints ahead of the converted text
+_RE_UNRTF_HEADER = re.compile(r'\A(?:###.*\n)*-+\n')
+
+# Single-pass cleanup: stray page-number lines, runs of blank lines, and
+# horizontal whitespace that needs collapsing (a lone space is left alone)
+_RE_CLEANUP = re.compile(r'(\n\s*\d+\s*\n)|(\n\s*\n)|[ \t]{2,}|\t')
+
+
+def _cleanup_replacement(match) -> str:
+    if match.group(1):
+        return '\n'
+    if match.group(2):
+        return '\n\n'
+    return ' '
+
+
+def _interleave(parts, separator: str):
+    """Yield parts with separator between them (a lazy str.join)"""
+    for i, part in enumerate(parts):
+        if i:
+            yield separator
+        yield part
+
+
+def _extract_pdf_page_range(path: str, start: int, stop: int) -> str:
+    """Extract text from pages [start, stop) of a PDF file (process pool worker)"""
+    import fitz
+    
+    doc = fitz.open(path, filetype="pdf")
+    try:
+        return '\n\n'.join(doc[i].get_text("text") for i in range(start, stop))
+    finally:
+        doc.close()
 
 
 class DocumentProcessor:
@@ -33,33 +88,81 @@ class DocumentProcessor:
         'rtf': ['.rtf']
     }
     
-    def __init__(self):
+    # PDFs longer than this are split into page ranges across worker processes
+    PDF_PAGES_PER_WORKER = 16
+    
+    DOWNLOAD_CHUNK_SIZE = 1 << 20
+    
+    # Same window libmagic inspects when sniffing content
+    SNIFF_BYTES = 3008
+    
+    # Extracted text is cached by content hash, in memory and on disk
+    CACHE_DIR = Path.home() / '.cache' / 'lumina-pdf'
+    CACHE_MAX_ENTRIES = 1024
+    CACHE_MAX_DISK_BYTES = 1 << 30
+    # Part of every cache key; bump whenever extraction or cleanup output
+    # changes, so text from older extractors is never served
+    EXTRACTOR_VERSION = 2
+    
+    # Seconds unrtf may run before falling back to striprtf
+    RTF_TIMEOUT = 60
+    
+    def __init__(self, max_workers: int = None):
         self.session = None
+        max_workers = max_workers or os.cpu_count() or 4
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._max_workers = max_workers
+        # forkserver, not fork: workers start while the event loop and the
+        # thread pools are running, and forking a threaded process is unsafe
+        self._process_pool = ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=multiprocessing.get_context('forkserver')
+        )
+        # Separate from _executor: extractors already run there and would
+        # deadlock waiting on sub-tasks queued behind themselves
+        self._parse_executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._extract_semaphore = asyncio.Semaphore(max_workers)
+        self._text_cache = OrderedDict()
+        # Native RTF converter, when installed; striprtf is used otherwise
+        self._unrtf_path = shutil.which('unrtf')
     
     async def download_file(self, url: str) -> dict:
         """Download file from URL and detect format"""
         if not self.session:
-            timeout = aiohttp.ClientTimeout(total=300)
-            self.session = aiohttp.ClientSession(timeout=timeout)
+            # One long-lived client so keep-alive connections and HTTP/2
+            # streams are reused across downloads from the same host. httpx
+            # advertises brotli alongside gzip once the brotli extra is present
+            self.session = httpx.AsyncClient(
+                http2=True,
+                follow_redirects=True,
+                timeout=httpx.Timeout(300, connect=10),
+                limits=httpx.Limits(max_connections=200, max_keepalive_connections=50, keepalive_expiry=75)
+            )
+        
+        # Hash while streaming so the body is only walked once
+        digest = blake3(max_threads=blake3.AUTO)
+        content = bytearray()
         
-        async with self.session.get(url) as response:
-            if response.status != 200:
-                raise Exception(f"Failed to download file: HTTP {response.status}")
+        async with self.session.stream('GET', url) as response:
+            if response.status_code != 200:
+                raise Exception(f"Failed to download file: HTTP {response.status_code}")
             
-            content = await response.read()
+            async for chunk in response.aiter_bytes(self.DOWNLOAD_CHUNK_SIZE):
+                digest.update(chunk)
+                content.extend(chunk)
             
             filename = self._extract_filename(url, response.headers)
-            file_format = self._detect_format(filename, content)
-            
-            file_id = hashlib.md5(content).hexdigest()[:12]
-            
-            return {
-                'content': content,
-                'filename': filename,
-                'format': file_format,
-                'file_id': file_id,
-                'size': len(content)
-            }
+        
+        file_format = self._detect_format(filename, content)
+        file_id = digest.hexdigest(length=6)
+        
+        return {
+            'content': content,
+            'filename': filename,
+            'format': file_format,
+            'file_id': file_id,
+            'size': len(content)
+        }
     
     def _extract_filename(self, url: str, headers: dict) -> str:
         """Extract filename from URL or headers"""
@@ -76,47 +179,75 @@ class DocumentProcessor:
         return filename or 'document'
     
     def _detect_format(self, filename: str, content: bytes) -> str:
-        """Detect document format from filename or content"""
+        """Detect document format from content signature or filename"""
         ext = Path(filename).suffix.lower()
+        head = content[:self.SNIFF_BYTES]
         
-        for format_type, extensions in self.SUPPORTED_FORMATS.items():
-            if ext in extensions:
-                return format_type
-        
-        if content.startswith(b'%PDF'):
+        # Magic bytes are authoritative; the extension only decides when the
+        # signature is ambiguous or missing
+        if head.startswith(b'%PDF'):
             return 'pdf'
-        elif content.startswith(b'PK\x03\x04'):
-            if b'word/' in content[:1000]:
-                return 'docx'
-            elif b'ppt/' in content[:1000]:
-                return 'pptx'
-            elif b'xl/' in content[:1000]:
-                return 'xlsx'
-            elif b'EPUB' in content[:100]:
-                return 'epub'
-        elif content.startswith(b'\xd0\xcf\x11\xe0'):
-            if ext == '.xls':
-                return 'xls'
-            elif ext == '.doc':
+        elif head.startswith(b'PK\x03\x04'):
+            match = _RE_ZIP_MARKER.search(head)
+            if match:
+                return _ZIP_MARKER_FORMATS[match.lastindex - 1]
+        elif head.startswith(b'\xd0\xcf\x11\xe0'):
+            if ext == '.doc':
                 return 'docx'
             elif ext == '.ppt':
                 return 'pptx'
             return 'xls'
-        elif content.startswith(b'{\\rtf'):
+        elif head.startswith(b'{\\rtf'):
             return 'rtf'
-        elif b'<html' in content[:1000].lower():
+        
+        for format_type, extensions in self.SUPPORTED_FORMATS.items():
+            if ext in extensions:
+                return format_type
+        
+        if _RE_HTML_TAG.search(head, 0, 1000):
             return 'html'
         
         return 'txt'
     
-    async def extract_text(self, content: bytes, format_type: str) -> str:
-        """Extract text from document based on format"""
+    async def extract_text(self, content: bytes, format_type: str, file_id: str = None) -> str:
+        """Extract text from document based on format
+        
+        When file_id (the content hash from download_file) is given, results
+        are cached and identical documents skip extraction entirely.
+        """
+        cache_key = f"{file_id}_{format_type}_v{self.EXTRACTOR_VERSION}" if file_id else None
+        if cache_key in self._text_cache:
+            self._text_cache.move_to_end(cache_key)
+            return self._text_cache[cache_key]
+        
+        extractor = self._get_extractor(format_type)
+        
+        # Extractors are blocking parsers, and the disk cache reads and writes
+        # multi-MB files; run both off the event loop so downloads and other
+        # documents keep making progress meanwhile
+        async with self._extract_semaphore:
+            loop = asyncio.get_running_loop()
+            text = await loop.run_in_executor(
+                self._executor, self._extract_cached_text, extractor, content, cache_key
+            )
+        
+        if cache_key:
+            self._remember_text(cache_key, text)
+        
+        return text
+    
+    def _get_extractor(self, format_type: str):
+        """Pick the extractor for a format
+        
+        Extractors return either a string or an iterable of text fragments
+        that concatenate to the document text.
+        """
         extractors = {
             'pdf': self._extract_pdf,
             'docx': self._extract_docx,
             'pptx': self._extract_pptx,
             'xlsx': self._extract_xlsx,
-            'xls': self._extract_xls,
+            'xls': self._extract_xlsx,
             'txt': self._extract_txt,
             'markdown': self._extract_txt,
             'html': self._extract_html,
@@ -124,15 +255,127 @@ class DocumentProcessor:
             'rtf': self._extract_rtf
         }
         
-        extractor = extractors.get(format_type, self._extract_txt)
-        text = await extractor(content)
-        
-        text = self._clean_text(text)
+        return extractors.get(format_type, self._extract_txt)
+    
+    def _extract_clean_text(self, extractor, content: bytes) -> str:
+        return ''.join(self._iter_clean_text(extractor(content)))
+    
+    def _extract_cached_text(self, extractor, content: bytes, key: str = None) -> str:
+        """Read extracted text from the disk cache, or extract and store it (worker thread)"""
+        if key:
+            path = self.CACHE_DIR / f"{key}.txt"
+            try:
+                text = path.read_text(encoding='utf-8')
+            except OSError:
+                pass
+            else:
+                # Recently used files are the last to be pruned
+                try:
+                    os.utime(path)
+                except OSError:
+                    pass
+                return text
         
+        text = self._extract_clean_text(extractor, content)
+        if key:
+            self._write_cached_text(key, text)
         return text
     
-    async def _extract_pdf(self, content: bytes) -> str:
-        """Extract text from PDF"""
+    def _write_cached_text(self, key: str, text: str):
+        """Store extracted text on disk (best-effort)
+        
+        Written to a temporary file and renamed into place, so a concurrent
+        reader of the same key sees the old file or the whole new one.
+        """
+        try:
+            self.CACHE_DIR.mkdir(parents=True, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.CACHE_DIR, suffix='.tmp')
+        except OSError:
+            return
+        
+        try:
+            with open(fd, 'w', encoding='utf-8') as f:
+                f.write(text)
+            os.replace(tmp_path, self.CACHE_DIR / f"{key}.txt")
+        except OSError:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            return
+        
+        self._prune_disk_cache()
+    
+    def _prune_disk_cache(self):
+        """Delete the least recently used cached texts beyond CACHE_MAX_DISK_BYTES"""
+        entries = []
+        try:
+            with os.scandir(self.CACHE_DIR) as it:
+                for entry in it:
+                    if entry.name.endswith('.txt'):
+                        stat = entry.stat()
+                        entries.append((stat.st_mtime, stat.st_size, entry.path))
+        except OSError:
+            return
+        
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.CACHE_MAX_DISK_BYTES:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            total -= size
+    
+    def _remember_text(self, key: str, text: str):
+        self._text_cache[key] = text
+        self._text_cache.move_to_end(key)
+        if len(self._text_cache) > self.CACHE_MAX_ENTRIES:
+            self._text_cache.popitem(last=False)
+    
+    def _extract_pdf(self, content: bytes):
+        """Extract text from PDF, yielding it page by page"""
+        import fitz
+        
+        try:
+            doc = fitz.open(stream=content, filetype="pdf")
+        except fitz.FileDataError:
+            yield self._extract_pdf_pypdf2(content)
+            return
+        
+        try:
+            page_count = doc.page_count
+            if page_count <= self.PDF_PAGES_PER_WORKER:
+                yield from _interleave((page.get_text("text") for page in doc), '\n\n')
+                return
+        finally:
+            doc.close()
+        
+        # At most one range per worker, each at least PDF_PAGES_PER_WORKER
+        # pages, and the file is written out once for the workers to open by
+        # path instead of pickling the whole PDF into every task
+        ranges = min(self._max_workers, -(-page_count // self.PDF_PAGES_PER_WORKER))
+        step = -(-page_count // ranges)
+        with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as tmp:
+            tmp.write(content)
+        
+        futures = []
+        try:
+            futures = [
+                self._process_pool.submit(_extract_pdf_page_range, tmp.name, start, min(start + step, page_count))
+                for start in range(0, page_count, step)
+            ]
+            yield from _interleave((future.result() for future in futures), '\n\n')
+        finally:
+            for future in futures:
+                future.cancel()
+            os.unlink(tmp.name)
+    
+    def _extract_pdf_pypdf2(self, content: bytes) -> str:
+        """Extract text from PDF with PyPDF2 (fallback for files PyMuPDF rejects)"""
+        import PyPDF2
+        
         pdf_file = BytesIO(content)
         pdf_reader = PyPDF2.PdfReader(pdf_file)
         
@@ -142,60 +385,163 @@ class DocumentProcessor:
         
         return '\n\n'.join(text_parts)
     
-    async def _extract_docx(self, content: bytes) -> str:
+    def _extract_docx(self, content: bytes) -> str:
         """Extract text from DOCX"""
-        docx_file = BytesIO(content)
-        
-        result = mammoth.convert_to_html(docx_file)
-        html_text = result.value
+        import mammoth
         
-        soup = BeautifulSoup(html_text, 'html.parser')
-        text = soup.get_text(separator='\n')
+        docx_file = BytesIO(content)
         
-        return text
+        result = mammoth.extract_raw_text(docx_file)
+        return result.value
     
-    async def _extract_txt(self, content: bytes) -> str:
+    def _extract_txt(self, content: bytes) -> str:
         """Extract text from plain text files"""
-        for encoding in ['utf-8', 'latin-1', 'cp1252']:
-            try:
-                return content.decode(encoding)
-            except UnicodeDecodeError:
-                continue
+        try:
+            return content.decode('utf-8')
+        except UnicodeDecodeError:
+            pass
+        
+        from charset_normalizer import from_bytes
         
-        return content.decode('utf-8', errors='ignore')
+        # latin-1 accepts any byte sequence, so guessing by trial decode never
+        # got past it; detect the real encoding instead
+        best = from_bytes(content).best()
+        if best is not None:
+            return str(best)
+        
+        return content.decode('utf-8', errors='replace')
     
-    async def _extract_html(self, content: bytes) -> str:
+    def _extract_html(self, content: bytes) -> str:
         """Extract text from HTML"""
-        html = await self._extract_txt(content)
-        soup = BeautifulSoup(html, 'html.parser')
+        # lexbor reads bytes as UTF-8 itself, so ASCII markup (the common case)
+        # skips the decode round-trip; anything else goes through detection
+        markup = bytes(content) if content.isascii() else self._extract_txt(content)
+        return self._html_to_text(markup, strip_tags=['script', 'style', 'noscript'])
+    
+    def _html_to_text(self, html, strip_tags: list = None, separator: str = '\n') -> str:
+        """Flatten HTML markup to plain text using the lexbor parser"""
+        from selectolax.lexbor import LexborHTMLParser
         
-        for script in soup(['script', 'style']):
-            script.decompose()
+        tree = LexborHTMLParser(html)
         
-        text = soup.get_text(separator='\n')
-        return text
+        if strip_tags:
+            tree.strip_tags(strip_tags)
+        
+        root = tree.body or tree.root
+        if root is None:
+            return ''
+        
+        return root.text(separator=separator)
     
-    async def _extract_epub(self, content: bytes) -> str:
-        """Extract text from EPUB"""
+    def _extract_epub(self, content: bytes):
+        """Extract text from EPUB, yielding it chapter by chapter"""
+        import ebooklib
+        from ebooklib import epub
+        
         epub_file = BytesIO(content)
         book = epub.read_epub(epub_file)
         
-        text_parts = []
-        for item in book.get_items():
-            if item.get_type() == ebooklib.ITEM_DOCUMENT:
-                soup = BeautifulSoup(item.get_content(), 'html.parser')
-                text_parts.append(soup.get_text())
+        documents = [item.get_content() for item in book.get_items_of_type(ebooklib.ITEM_DOCUMENT)]
         
-        return '\n\n'.join(text_parts)
+        # Chapters are independent; parse them concurrently, keeping book order
+        texts = self._parse_executor.map(partial(self._html_to_text, separator=''), documents)
+        
+        yield from _interleave(texts, '\n\n')
     
-    async def _extract_rtf(self, content: bytes) -> str:
+    def _extract_rtf(self, content: bytes) -> str:
         """Extract text from RTF"""
-        rtf_text = await self._extract_txt(content)
+        if self._unrtf_path:
+            try:
+                proc = subprocess.run(
+                    [self._unrtf_path, '--text', '--nopict'],
+                    input=bytes(content),
+                    capture_output=True,
+                    timeout=self.RTF_TIMEOUT
+                )
+            except subprocess.TimeoutExpired:
+                proc = None
+            if proc is not None and proc.returncode == 0:
+                text = proc.stdout.decode('utf-8', errors='replace')
+                return _RE_UNRTF_HEADER.sub('', text, count=1)
+        
+        from striprtf.striprtf import rtf_to_text
+        
+        rtf_text = self._extract_txt(content)
         text = rtf_to_text(rtf_text)
         return text
     
-    async def _extract_pptx(self, content: bytes) -> str:
-        """Extract text from PowerPoint"""
+    def _extract_pptx(self, content: bytes):
+        """Extract text from PowerPoint, yielding it slide by slide
+        
+        Reads the <a:t> text runs straight out of the slide XML rather than
+        building python-pptx's full object model, which is only used as a
+        fallback for files that aren't plain OOXML archives.
+        """
+        try:
+            with zipfile.ZipFile(BytesIO(content)) as archive:
+                slides = [archive.read(name) for name in self._pptx_slide_names(archive)]
+        except zipfile.BadZipFile:
+            slides = []
+        
+        if not slides:
+            yield self._extract_pptx_object_model(content)
+            return
+        
+        for slide_num, slide_xml in enumerate(slides, 1):
+            if slide_num > 1:
+                yield '\n\n'
+            yield f"\n--- Slide {slide_num} ---\n"
+            paragraphs = (
+                b''.join(_RE_PPTX_TEXT_RUN.findall(paragraph))
+                for paragraph in _RE_PPTX_PARAGRAPH.findall(slide_xml)
+            )
+            slide_text = b'\n'.join(p for p in paragraphs if p.strip())
+            if slide_text:
+                yield '\n\n'
+                yield html.unescape(slide_text.decode('utf-8', errors='replace'))
+    
+    def _pptx_slide_names(self, archive: zipfile.ZipFile) -> list:
+        """Slide part names in presentation order
+        
+        The order is the presentation's slide id list, resolved through its
+        relationships, as python-pptx reads it; part names need not follow
+        it. Falls back to the number in the part name if that list can't be
+        read.
+        """
+        members = set(archive.namelist())
+        try:
+            presentation = ElementTree.fromstring(archive.read('ppt/presentation.xml'))
+            rels = ElementTree.fromstring(archive.read('ppt/_rels/presentation.xml.rels'))
+        except (KeyError, ElementTree.ParseError):
+            presentation = rels = None
+        
+        names = []
+        if presentation is not None:
+            targets = {rel.get('Id'): rel.get('Target') for rel in rels.iter(_OPC_RELATIONSHIP)}
+            for slide_id in presentation.iter(_PPTX_SLIDE_ID):
+                target = targets.get(slide_id.get(_PPTX_SLIDE_REL_ID))
+                if not target:
+                    continue
+                # Targets are relative to ppt/, or absolute within the package
+                if target.startswith('/'):
+                    name = target[1:]
+                else:
+                    name = posixpath.normpath(posixpath.join('ppt', target))
+                if name in members:
+                    names.append(name)
+        
+        if names:
+            return names
+        
+        return sorted(
+            (name for name in members if _RE_PPTX_SLIDE_NAME.fullmatch(name)),
+            key=lambda name: int(_RE_PPTX_SLIDE_NAME.fullmatch(name).group(1))
+        )
+    
+    def _extract_pptx_object_model(self, content: bytes) -> str:
+        """Extract text from PowerPoint via python-pptx"""
+        from pptx import Presentation
+        
         pptx_file = BytesIO(content)
         prs = Presentation(pptx_file)
         
@@ -208,47 +554,68 @@ class DocumentProcessor:
         
         return '\n\n'.join(text_parts)
     
-    async def _extract_xlsx(self, content: bytes) -> str:
-        """Extract text from Excel (new format)"""
-        xlsx_file = BytesIO(content)
-        wb = load_workbook(xlsx_file, data_only=True)
+    def _extract_xlsx(self, content: bytes):
+        """Extract text from Excel (.xlsx and legacy .xls), yielding it row by row"""
+        from python_calamine import CalamineWorkbook
         
-        text_parts = []
-        for sheet in wb.worksheets:
-            text_parts.append(f"\n=== Sheet: {sheet.title} ===\n")
-            for row in sheet.iter_rows(values_only=True):
-                row_text = '\t'.join([str(cell) if cell is not None else '' for cell in row])
-                if row_text.strip():
-                    text_parts.append(row_text)
+        wb = CalamineWorkbook.from_filelike(BytesIO(content))
         
-        return '\n'.join(text_parts)
-    
-    async def _extract_xls(self, content: bytes) -> str:
-        """Extract text from Excel (old .xls format)"""
-        xls_file = BytesIO(content)
-        wb = xlrd.open_workbook(file_contents=content)
+        def lines():
+            for sheet_name in wb.sheet_names:
+                yield f"\n=== Sheet: {sheet_name} ===\n"
+                for row in wb.get_sheet_by_name(sheet_name).to_python():
+                    row_text = '\t'.join([str(cell) if cell is not None else '' for cell in row])
+                    if row_text.strip():
+                        yield row_text
         
-        text_parts = []
-        for sheet in wb.sheets():
-            text_parts.append(f"\n=== Sheet: {sheet.name} ===\n")
-            for row_idx in range(sheet.nrows):
-                row = sheet.row_values(row_idx)
-                row_text = '\t'.join([str(cell) if cell else '' for cell in row])
-                if row_text.strip():
-                    text_parts.append(row_text)
-        
-        return '\n'.join(text_parts)
-    
-    def _clean_text(self, text: str) -> str:
-        """Clean and normalize extracted text"""
-        text = re.sub(r'\n\s*\n', '\n\n', text)
-        text = re.sub(r'[ \t]+', ' ', text)
-        text = re.sub(r'\n\s*\d+\s*\n', '\n', text)
+        yield from _interleave(lines(), '\n')
+    
+    def _clean_segment(self, text: str) -> str:
         text = text.replace('\r\n', '\n')
+        return _RE_CLEANUP.sub(_cleanup_replacement, text)
+    
+    def _iter_clean_text(self, fragments):
+        """Clean a stream of text fragments, yielding cleaned chunks
+        
+        Cleanup matches only ever span whitespace and digits, so text is cut
+        just after the last other character: nothing can match across that
+        point and each piece cleans exactly as it would inside the whole.
+        """
+        if isinstance(fragments, str):
+            fragments = (fragments,)
+        
+        # Text held back since the last cut; all whitespace and digits, so
+        # the cut point is only ever searched for in the newest fragment
+        pending = []
+        started = False
+        for fragment in fragments:
+            cut = len(fragment)
+            while cut and (fragment[cut - 1].isspace() or fragment[cut - 1].isdigit()):
+                cut -= 1
+            if not cut:
+                pending.append(fragment)
+                continue
+            
+            pending.append(fragment[:cut])
+            chunk = self._clean_segment(''.join(pending))
+            pending = [fragment[cut:]]
+            if not started:
+                chunk = chunk.lstrip()
+                started = bool(chunk)
+            if chunk:
+                yield chunk
         
-        return text.strip()
+        tail = self._clean_segment(''.join(pending))
+        if not started:
+            tail = tail.lstrip()
+        tail = tail.rstrip()
+        if tail:
+            yield tail
     
     async def close(self):
-        """Close aiohttp session"""
+        """Close HTTP client and extraction workers"""
         if self.session:
-            await self.session.close()
\ No newline at end of file
+            await self.session.aclose()
+        self._executor.shutdown(wait=False)
+        self._process_pool.shutdown(wait=False)
+        self._parse_executor.shutdown(wait=False)
\ No newline at end of file
@@ -8,196 +8,111 @@ from reportlab.lib.units import inch
 from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle, PageBreak
 from reportlab.lib import colors
 from reportlab.lib.enums import TA_CENTER, TA_LEFT
+import csv
+import io
 from io import BytesIO
 import json
+from itertools import zip_longest
 from typing import Dict, Any
+import jinja2
 
-
-class ExportManager:
-    """Generate exports in various formats"""
-    
-    def create_exports(self, study_materials: Dict[str, Any], metadata: Dict[str, Any]) -> Dict[str, Any]:
-        """Create all export formats"""
-        
-        exports = {}
-        
-        # Anki CSV
-        if 'flashcards' in study_materials:
-            exports['anki_csv'] = self._create_anki_csv(study_materials['flashcards'])
-        
-        # Notion Markdown
-        exports['notion_md'] = self._create_notion_markdown(study_materials, metadata)
-        
-        # Interactive HTML Quiz
-        if 'quiz' in study_materials:
-            exports['quiz_html'] = self._create_quiz_html(study_materials['quiz'], metadata)
-        
-        # JSON export
-        exports['json'] = json.dumps({
-            'metadata': metadata,
-            'studyMaterials': study_materials
-        }, indent=2)
-        
-        # PDF export
-        exports['pdf'] = self._create_pdf(study_materials, metadata)
-        
-        return exports
-    
-    def _create_anki_csv(self, flashcards: list) -> str:
-        """Generate Anki-compatible CSV"""
-        
-        csv_lines = ['Front,Back,Tags']
-        
-        for card in flashcards:
-            front = card['front'].replace('"', '""')
-            back = card['back'].replace('"', '""')
-            tags = ' '.join(card.get('tags', [])).replace('"', '""')
-            
-            csv_lines.append(f'"{front}","{back}","{tags}"')
-        
-        return '\n'.join(csv_lines)
-    
-    def _create_notion_markdown(self, materials: Dict, metadata: Dict) -> str:
-        """Generate Notion-optimized markdown with callouts"""
-        
-        md_parts = []
-        
-        # Header
-        md_parts.append(f"# 📚 Study Guide: {metadata.get('filename', 'Document')}\n")
-        md_parts.append(f"**Source:** {metadata.get('source_url', 'N/A')}")
-        md_parts.append(f"**Processed:** {metadata.get('processed_at', 'N/A')}\n")
-        md_parts.append("---\n")
-        
-        # Summary
-        if 'summary' in materials:
-            summary = materials['summary']
-            md_parts.append("## 📋 Executive Summary\n")
-            md_parts.append(f"{summary.get('overview', '')}\n")
-            
-            if summary.get('keyPoints'):
-                md_parts.append("### Key Points\n")
-                for point in summary['keyPoints']:
-                    md_parts.append(f"- **{point['point']}**: {point.get('details', '')}")
-                md_parts.append("")
-            
-            if summary.get('conclusion'):
-                md_parts.append(f"> [!TIP] Conclusion\n> {summary['conclusion']}\n")
-        
-        # Cornell Notes
-        if 'cornellNotes' in materials:
-            notes = materials['cornellNotes']
-            md_parts.append("## 📝 Cornell Notes\n")
-            
-            md_parts.append("| Cues | Notes |")
-            md_parts.append("|------|-------|")
-            
-            cues = notes.get('cues', [])
-            note_items = notes.get('notes', [])
-            
-            for i in range(max(len(cues), len(note_items))):
-                cue = cues[i] if i < len(cues) else ''
-                note = note_items[i] if i < len(note_items) else ''
-                md_parts.append(f"| {cue} | {note} |")
-            
-            md_parts.append("")
-            
-            if notes.get('summary'):
-                md_parts.append(f"> [!NOTE] Summary\n> {notes['summary']}\n")
-        
-        # Flashcards
-        if 'flashcards' in materials:
-            md_parts.append("## 🎴 Flashcards\n")
-            
-            for i, card in enumerate(materials['flashcards'], 1):
-                difficulty = card.get('difficulty', 'medium')
-                emoji = {'easy': '🟢', 'medium': '🟡', 'hard': '🔴'}.get(difficulty, '🟡')
-                
-                md_parts.append(f"### {emoji} Card {i}")
-                md_parts.append(f"> [!QUESTION] Question\n> {card['front']}\n")
-                md_parts.append(f"> [!SUCCESS] Answer\n> {card['back']}\n")
-                
-                if card.get('tags'):
-                    tags = ', '.join([f"`{tag}`" for tag in card['tags']])
-                    md_parts.append(f"**Tags:** {tags}\n")
-        
-        # Quiz
-        if 'quiz' in materials:
-            quiz = materials['quiz']
-            md_parts.append("## 📊 Practice Quiz\n")
-            
-            for i, q in enumerate(quiz.get('questions', []), 1):
-                md_parts.append(f"### Question {i}\n")
-                md_parts.append(f"{q['question']}\n")
-                
-                for option in q.get('options', []):
-                    md_parts.append(f"- {option}")
-                
-                md_parts.append("")
-                md_parts.append(f"> [!SUCCESS] Answer: {q['correctAnswer']}")
-                md_parts.append(f"> {q.get('explanation', '')}\n")
-        
-        # Mind Map
-        if 'mindMap' in materials:
-            md_parts.append("## 🗺️ Mind Map\n")
-            md_parts.append("```mermaid")
-            md_parts.append(materials['mindMap'])
-            md_parts.append("```\n")
-        
-        return '\n'.join(md_parts)
+try:
+    import orjson
     
-    def _create_quiz_html(self, quiz: Dict, metadata: Dict) -> str:
-        """Generate interactive HTML quiz"""
-        
-        html = f"""<!DOCTYPE html>
+    def _dumps(obj) -> str:
+        return orjson.dumps(obj).decode()
+except ImportError:
+    def _dumps(obj) -> str:
+        return json.dumps(obj)
+
+
+# PDF palette and the Cornell notes table style, parsed/built once at import
+_PRIMARY_COLOR = colors.HexColor('#667eea')
+_ACCENT_COLOR = colors.HexColor('#764ba2')
+
+_CORNELL_TABLE_STYLE = TableStyle([
+    ('BACKGROUND', (0, 0), (-1, 0), _PRIMARY_COLOR),
+    ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+    ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
+    ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+    ('FONTSIZE', (0, 0), (-1, 0), 12),
+    ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
+    ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
+    ('GRID', (0, 0), (-1, -1), 1, colors.black),
+    ('VALIGN', (0, 0), (-1, -1), 'TOP'),
+])
+
+_DIFFICULTY_EMOJI = {'easy': '🟢', 'medium': '🟡', 'hard': '🔴'}
+
+# Markdown only needs raw HTML neutralised; quotes stay readable
+_MARKDOWN_ESCAPE_TABLE = str.maketrans({
+    '&': '&amp;',
+    '<': '&lt;',
+    '>': '&gt;'
+})
+
+
+def _md_esc(value) -> str:
+    """Escape text for markdown prose (not code spans or fences)"""
+    return str(value).translate(_MARKDOWN_ESCAPE_TABLE)
+
+
+# Interactive quiz page, compiled once at import. Autoescaping covers every
+# interpolated value, including model output.
+_QUIZ_HTML_TEMPLATE = jinja2.Environment(
+    autoescape=True,
+    trim_blocks=True,
+    lstrip_blocks=True
+).from_string("""<!DOCTYPE html>
 <html lang="en">
 <head>
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>Quiz: {metadata.get('filename', 'Document')}</title>
+    <title>Quiz: {{ title }}</title>
     <style>
-        * {{ margin: 0; padding: 0; box-sizing: border-box; }}
-        body {{
+        * { margin: 0; padding: 0; box-sizing: border-box; }
+        body {
             font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, Oxygen, Ubuntu, sans-serif;
             background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
             min-height: 100vh;
             padding: 2rem;
-        }}
-        .container {{
+        }
+        .container {
             max-width: 800px;
             margin: 0 auto;
             background: white;
             border-radius: 20px;
             padding: 2rem;
             box-shadow: 0 20px 60px rgba(0,0,0,0.3);
-        }}
-        h1 {{
+        }
+        h1 {
             color: #667eea;
             margin-bottom: 0.5rem;
             font-size: 2rem;
-        }}
-        .metadata {{
+        }
+        .metadata {
             color: #666;
             margin-bottom: 2rem;
             padding-bottom: 1rem;
             border-bottom: 2px solid #f0f0f0;
-        }}
-        .question {{
+        }
+        .question {
             margin-bottom: 2rem;
             padding: 1.5rem;
             background: #f9f9f9;
             border-radius: 12px;
             border-left: 4px solid #667eea;
-        }}
-        .question-text {{
+        }
+        .question-text {
             font-size: 1.1rem;
             font-weight: 600;
             margin-bottom: 1rem;
             color: #333;
-        }}
-        .options {{
+        }
+        .options {
             list-style: none;
-        }}
-        .option {{
+        }
+        .option {
             padding: 0.75rem 1rem;
             margin: 0.5rem 0;
             background: white;
@@ -205,27 +120,27 @@ class ExportManager:
             border-radius: 8px;
             cursor: pointer;
             transition: all 0.3s;
-        }}
-        .option:hover {{
+        }
+        .option:hover {
             border-color: #667eea;
             transform: translateX(5px);
-        }}
-        .explanation {{
+        }
+        .explanation {
             margin-top: 1rem;
             padding: 1rem;
             background: #e8f5e9;
             border-radius: 8px;
             display: none;
-        }}
-        .explanation.show {{
+        }
+        .explanation.show {
             display: block;
             animation: slideDown 0.3s ease;
-        }}
-        @keyframes slideDown {{
-            from {{ opacity: 0; transform: translateY(-10px); }}
-            to {{ opacity: 1; transform: translateY(0); }}
-        }}
-        .show-answer-btn {{
+        }
+        @keyframes slideDown {
+            from { opacity: 0; transform: translateY(-10px); }
+            to { opacity: 1; transform: translateY(0); }
+        }
+        .show-answer-btn {
             margin-top: 1rem;
             padding: 0.5rem 1rem;
             background: #667eea;
@@ -235,52 +150,48 @@ class ExportManager:
             cursor: pointer;
             font-weight: 600;
             transition: background 0.3s;
-        }}
-        .show-answer-btn:hover {{
+        }
+        .show-answer-btn:hover {
             background: #764ba2;
-        }}
-        .correct-answer {{
+        }
+        .correct-answer {
             color: #2e7d32;
             font-weight: 600;
-        }}
-        .footer {{
+        }
+        .footer {
             margin-top: 2rem;
             padding-top: 1rem;
             border-top: 2px solid #f0f0f0;
             text-align: center;
             color: #666;
-        }}
+        }
     </style>
 </head>
 <body>
     <div class="container">
         <h1>📊 Practice Quiz</h1>
         <div class="metadata">
-            <strong>Document:</strong> {metadata.get('filename', 'N/A')}<br>
-            <strong>Questions:</strong> {len(quiz.get('questions', []))}
+            <strong>Document:</strong> {{ filename }}<br>
+            <strong>Questions:</strong> {{ questions|length }}
         </div>
-"""
-        
-        for i, q in enumerate(quiz.get('questions', []), 1):
-            html += f"""
+{% for q in questions %}
+
         <div class="question">
-            <div class="question-text">{i}. {q['question']}</div>
+            <div class="question-text">{{ loop.index }}. {{ q.question }}</div>
             <ul class="options">
-"""
-            for option in q.get('options', []):
-                html += f"                <li class='option'>{option}</li>\n"
-            
-            html += f"""
+{% for option in q.options %}
+                <li class='option'>{{ option }}</li>
+{% endfor %}
+
             </ul>
-            <button class="show-answer-btn" onclick="toggleAnswer({i})">Show Answer</button>
-            <div class="explanation" id="explanation-{i}">
-                <div class="correct-answer">✓ Correct Answer: {q['correctAnswer']}</div>
-                <p style="margin-top: 0.5rem;">{q.get('explanation', '')}</p>
+            <button class="show-answer-btn" onclick="toggleAnswer({{ loop.index }})">Show Answer</button>
+            <div class="explanation" id="explanation-{{ loop.index }}">
+                <div class="correct-answer">✓ Correct Answer: {{ q.correctAnswer }}</div>
+                <p style="margin-top: 0.5rem;">{{ q.explanation }}</p>
             </div>
         </div>
-"""
-        
-        html += """
+{% endfor %}
+
         <div class="footer">
             Good luck with your studies! 📚✨
         </div>
@@ -292,12 +203,190 @@ class ExportManager:
         }
     </script>
 </body>
-</html>"""
+</html>""")
+
+
+class ExportManager:
+    """Generate exports in various formats"""
+    
+    EXPORT_FORMATS = ('anki_csv', 'notion_md', 'quiz_html', 'json', 'pdf')
+    
+    def __init__(self):
+        # ReportLab styles are only read while building, so they are set up
+        # once and shared by every PDF this manager renders
+        self._styles = getSampleStyleSheet()
+        self._title_style = ParagraphStyle(
+            'CustomTitle',
+            parent=self._styles['Heading1'],
+            fontSize=24,
+            textColor=_PRIMARY_COLOR,
+            spaceAfter=12,
+            alignment=TA_CENTER
+        )
+        self._heading_style = ParagraphStyle(
+            'CustomHeading',
+            parent=self._styles['Heading2'],
+            fontSize=16,
+            textColor=_ACCENT_COLOR,
+            spaceAfter=12,
+            spaceBefore=12
+        )
+        # Bold via the font rather than <b> markup, so card headers stay plain text
+        self._card_style = ParagraphStyle(
+            'CardHeader',
+            parent=self._styles['Normal'],
+            fontName='Helvetica-Bold'
+        )
+    
+    def create_exports(self, study_materials: Dict[str, Any], metadata: Dict[str, Any],
+                       formats=None) -> Dict[str, Any]:
+        """Create the requested export formats (all of EXPORT_FORMATS by default)"""
+        
+        formats = set(formats) if formats is not None else set(self.EXPORT_FORMATS)
+        exports = {}
+        
+        # Anki CSV
+        if 'anki_csv' in formats and 'flashcards' in study_materials:
+            exports['anki_csv'] = self._create_anki_csv(study_materials['flashcards'])
         
-        return html
+        # Notion Markdown
+        if 'notion_md' in formats:
+            exports['notion_md'] = self._create_notion_markdown(study_materials, metadata)
+        
+        # Interactive HTML Quiz
+        if 'quiz_html' in formats and 'quiz' in study_materials:
+            exports['quiz_html'] = self._create_quiz_html(study_materials['quiz'], metadata)
+        
+        # JSON export
+        if 'json' in formats:
+            exports['json'] = _dumps({
+                'metadata': metadata,
+                'studyMaterials': study_materials
+            })
+        
+        # PDF export (by far the most expensive)
+        if 'pdf' in formats:
+            exports['pdf'] = self._create_pdf(study_materials, metadata)
+        
+        return exports
+    
+    def _create_anki_csv(self, flashcards: list) -> str:
+        """Generate Anki-compatible CSV"""
+        
+        buf = io.StringIO()
+        buf.write('Front,Back,Tags\n')
+        
+        writer = csv.writer(buf, quoting=csv.QUOTE_ALL, lineterminator='\n')
+        writer.writerows(
+            (card['front'], card['back'], ' '.join(card.get('tags', ())))
+            for card in flashcards
+        )
+        
+        return buf.getvalue()
+    
+    def _create_notion_markdown(self, materials: Dict, metadata: Dict) -> str:
+        """Generate Notion-optimized markdown with callouts"""
+        
+        buf = io.StringIO()
+        write = buf.write
+        
+        # Header
+        write(f"# 📚 Study Guide: {_md_esc(metadata.get('filename', 'Document'))}\n\n")
+        write(f"**Source:** {metadata.get('source_url', 'N/A')}\n")
+        write(f"**Processed:** {metadata.get('processed_at', 'N/A')}\n\n")
+        write("---\n\n")
+        
+        # Summary
+        if 'summary' in materials:
+            summary = materials['summary']
+            write("## 📋 Executive Summary\n\n")
+            write(f"{_md_esc(summary.get('overview', ''))}\n\n")
+            
+            if summary.get('keyPoints'):
+                write("### Key Points\n\n")
+                for point in summary['keyPoints']:
+                    write(f"- **{_md_esc(point['point'])}**: {_md_esc(point.get('details', ''))}\n")
+                write("\n")
+            
+            if summary.get('conclusion'):
+                write(f"> [!TIP] Conclusion\n> {_md_esc(summary['conclusion'])}\n\n")
+        
+        # Cornell Notes
+        if 'cornellNotes' in materials:
+            notes = materials['cornellNotes']
+            write("## 📝 Cornell Notes\n\n")
+            
+            write("| Cues | Notes |\n")
+            write("|------|-------|\n")
+            
+            cues = notes.get('cues', [])
+            note_items = notes.get('notes', [])
+            
+            for cue, note in zip_longest(cues, note_items, fillvalue=''):
+                write(f"| {_md_esc(cue)} | {_md_esc(note)} |\n")
+            
+            write("\n")
+            
+            if notes.get('summary'):
+                write(f"> [!NOTE] Summary\n> {_md_esc(notes['summary'])}\n\n")
+        
+        # Flashcards
+        if 'flashcards' in materials:
+            write("## 🎴 Flashcards\n\n")
+            
+            for i, card in enumerate(materials['flashcards'], 1):
+                emoji = _DIFFICULTY_EMOJI.get(card.get('difficulty', 'medium'), '🟡')
+                
+                write(f"### {emoji} Card {i}\n")
+                write(f"> [!QUESTION] Question\n> {_md_esc(card['front'])}\n\n")
+                write(f"> [!SUCCESS] Answer\n> {_md_esc(card['back'])}\n\n")
+                
+                if card.get('tags'):
+                    tags = ', '.join([f"`{tag}`" for tag in card['tags']])
+                    write(f"**Tags:** {tags}\n\n")
+        
+        # Quiz
+        if 'quiz' in materials:
+            quiz = materials['quiz']
+            write("## 📊 Practice Quiz\n\n")
+            
+            for i, q in enumerate(quiz.get('questions', []), 1):
+                write(f"### Question {i}\n\n")
+                write(f"{_md_esc(q['question'])}\n\n")
+                
+                for option in q.get('options', []):
+                    write(f"- {_md_esc(option)}\n")
+                
+                write("\n")
+                write(f"> [!SUCCESS] Answer: {_md_esc(q['correctAnswer'])}\n")
+                write(f"> {_md_esc(q.get('explanation', ''))}\n\n")
+        
+        # Mind Map
+        if 'mindMap' in materials:
+            write("## 🗺️ Mind Map\n\n")
+            write("```mermaid\n")
+            write(materials['mindMap'])
+            write("\n")
+            write("```\n\n")
+        
+        return buf.getvalue()
+    
+    def _create_quiz_html(self, quiz: Dict, metadata: Dict) -> str:
+        """Generate interactive HTML quiz"""
+        
+        return _QUIZ_HTML_TEMPLATE.render(
+            title=metadata.get('filename', 'Document'),
+            filename=metadata.get('filename', 'N/A'),
+            questions=quiz.get('questions', [])
+        )
     
     def _create_pdf(self, materials: Dict, metadata: Dict) -> bytes:
-        """Generate professional PDF study guide"""
+        """Generate professional PDF study guide
+        
+        Returns plain bytes on purpose: BytesIO.getvalue() hands over the
+        buffer without copying when nothing else references it, so there is
+        no second copy to save, and bytes is what Actor.set_value expects.
+        """
         
         buffer = BytesIO()
         doc = SimpleDocTemplate(buffer, pagesize=letter, rightMargin=72, leftMargin=72,
@@ -307,24 +396,9 @@ class ExportManager:
         story = []
         
         # Styles
-        styles = getSampleStyleSheet()
-        title_style = ParagraphStyle(
-            'CustomTitle',
-            parent=styles['Heading1'],
-            fontSize=24,
-            textColor=colors.HexColor('#667eea'),
-            spaceAfter=12,
-            alignment=TA_CENTER
-        )
-        
-        heading_style = ParagraphStyle(
-            'CustomHeading',
-            parent=styles['Heading2'],
-            fontSize=16,
-            textColor=colors.HexColor('#764ba2'),
-            spaceAfter=12,
-            spaceBefore=12
-        )
+        styles = self._styles
+        title_style = self._title_style
+        heading_style = self._heading_style
         
         # Helper function to escape XML characters
         def escape_xml(text):
@@ -357,9 +431,10 @@ class ExportManager:
             
             if summary.get('keyPoints'):
                 story.append(Paragraph("<b>Key Points:</b>", styles['Normal']))
+                bullet = styles['Bullet']
                 for point in summary['keyPoints']:
-                    point_text = f"• <b>{escape_xml(point['point'])}</b>: {escape_xml(point.get('details', ''))}"
-                    story.append(Paragraph(point_text, styles['Normal']))
+                    point_text = f"<b>{escape_xml(point['point'])}</b>: {escape_xml(point.get('details', ''))}"
+                    story.append(Paragraph(point_text, bullet, bulletText='•'))
                 story.append(Spacer(1, 0.2*inch))
         
         # Cornell Notes
@@ -368,27 +443,16 @@ class ExportManager:
             story.append(Paragraph("Cornell Notes", heading_style))
             
             # Create table with escaped content
-            table_data = [['Cues', 'Notes']]
             cues = notes.get('cues', [])
             note_items = notes.get('notes', [])
-            
-            for i in range(max(len(cues), len(note_items))):
-                cue = escape_xml(cues[i]) if i < len(cues) else ''
-                note = escape_xml(note_items[i]) if i < len(note_items) else ''
-                table_data.append([cue, note])
+            table_data = [
+                ['Cues', 'Notes'],
+                *([escape_xml(cue), escape_xml(note)]
+                  for cue, note in zip_longest(cues, note_items, fillvalue=''))
+            ]
             
             table = Table(table_data, colWidths=[2*inch, 4*inch])
-            table.setStyle(TableStyle([
-                ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#667eea')),
-                ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-                ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
-                ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-                ('FONTSIZE', (0, 0), (-1, 0), 12),
-                ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-                ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
-                ('GRID', (0, 0), (-1, -1), 1, colors.black),
-                ('VALIGN', (0, 0), (-1, -1), 'TOP'),
-            ]))
+            table.setStyle(_CORNELL_TABLE_STYLE)
             
             story.append(table)
             story.append(Spacer(1, 0.2*inch))
@@ -398,11 +462,20 @@ class ExportManager:
             story.append(PageBreak())
             story.append(Paragraph("Flashcards", heading_style))
             
-            for i, card in enumerate(materials['flashcards'], 1):
-                story.append(Paragraph(f"<b>Card {i}</b>", styles['Normal']))
-                story.append(Paragraph(f"<i>Q: {escape_xml(card['front'])}</i>", styles['Normal']))
-                story.append(Paragraph(f"A: {escape_xml(card['back'])}", styles['Normal']))
-                story.append(Spacer(1, 0.1*inch))
+            # Spacer carries no per-use state, so one instance serves every card
+            normal = styles['Normal']
+            card_style = self._card_style
+            card_gap = Spacer(1, 0.1*inch)
+            story.extend(
+                flowable
+                for i, card in enumerate(materials['flashcards'], 1)
+                for flowable in (
+                    Paragraph(f"Card {i}", card_style),
+                    Paragraph(f"<i>Q: {escape_xml(card['front'])}</i>", normal),
+                    Paragraph(f"A: {escape_xml(card['back'])}", normal),
+                    card_gap
+                )
+            )
         
         # Build PDF
         doc.build(story)
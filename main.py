@@ -8,10 +8,33 @@ import asyncio
 from pathlib import Path
 import json
 from datetime import datetime
-from study_generator import StudyMaterialGenerator
+from study_generator import StudyMaterialGenerator, close_clients
 from export_utils import ExportManager
 from document_processor import DocumentProcessor
 
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+
+# Actor input names for exports -> ExportManager format keys
+EXPORT_FORMAT_KEYS = {
+    'pdf': 'pdf',
+    'ankiCsv': 'anki_csv',
+    'notionMarkdown': 'notion_md',
+    'quizHtml': 'quiz_html',
+    'json': 'json'
+}
+
+# Stateless apart from its ReportLab styles, so one instance serves every run.
+# DocumentProcessor and StudyMaterialGenerator stay per-run: the processor's
+# HTTP client belongs to the run's event loop, and the generator to its API
+# key (its Claude client comes from study_generator's pool).
+_export_mgr = ExportManager()
+
+# Dataset items per Actor.push_data call
+PUSH_BATCH_SIZE = 50
 
 async def main():
     async with Actor:
@@ -19,8 +42,9 @@ async def main():
         actor_input = await Actor.get_input() or {}
         
         # Extract configuration
-        file_urls = actor_input.get('fileUrls', '').strip().split('\n')
-        file_urls = [url.strip() for url in file_urls if url.strip()]
+        file_urls = [
+            url.strip() for url in actor_input.get('fileUrls', '').splitlines() if url.strip()
+        ]
         
         if not file_urls:
             Actor.log.error('No document URLs provided')
@@ -34,6 +58,11 @@ async def main():
         num_flashcards = actor_input.get('numFlashcards', 30)
         num_quiz_questions = actor_input.get('numQuizQuestions', 20)
         difficulty_level = actor_input.get('difficultyLevel', 'mixed')
+        export_formats = {
+            EXPORT_FORMAT_KEYS[name]
+            for name in actor_input.get('exportFormats', list(EXPORT_FORMAT_KEYS))
+            if name in EXPORT_FORMAT_KEYS
+        }
         user_api_key = actor_input.get('anthropicApiKey', '').strip() or None
         
         Actor.log.info(f'Processing {len(file_urls)} document(s)')
@@ -46,115 +75,185 @@ async def main():
         # Initialize processors
         doc_processor = DocumentProcessor()
         study_gen = StudyMaterialGenerator(user_api_key=user_api_key)
-        export_mgr = ExportManager()
+        export_mgr = _export_mgr
         
-        # Process each document
-        for idx, file_url in enumerate(file_urls, 1):
-            try:
-                Actor.log.info(f'[{idx}/{len(file_urls)}] Processing: {file_url}')
-                
-                # Download and extract text from document
-                Actor.log.info('Downloading document...')
-                file_data = await doc_processor.download_file(file_url)
-                
-                Actor.log.info(f'Extracting text from {file_data["format"]}...')
-                extracted_text = await doc_processor.extract_text(
-                    file_data['content'],
-                    file_data['format']
-                )
-                
-                if not extracted_text or len(extracted_text.strip()) < 100:
-                    Actor.log.warning(f'Insufficient text extracted from {file_url}')
-                    continue
-                
-                Actor.log.info(f'Extracted {len(extracted_text)} characters')
-                
-                # Generate study materials
-                Actor.log.info('Generating study materials with AI...')
-                study_materials = await study_gen.generate_materials(
-                    text=extracted_text,
-                    metadata={
-                        'source_url': file_url,
-                        'filename': file_data['filename'],
-                        'format': file_data['format']
-                    },
-                    formats=output_formats,
-                    num_flashcards=num_flashcards,
-                    num_quiz_questions=num_quiz_questions,
-                    difficulty=difficulty_level
-                )
-                
-                # Generate exports
-                Actor.log.info('Creating export formats...')
-                exports = export_mgr.create_exports(
-                    study_materials=study_materials,
-                    metadata={
-                        'filename': file_data['filename'],
-                        'source_url': file_url,
-                        'processed_at': datetime.utcnow().isoformat() + 'Z'
-                    }
-                )
+        concurrency = max(1, actor_input.get('concurrency', 4))
+        semaphore = asyncio.Semaphore(concurrency)
+        # One slot per input URL, so dataset items keep the input order
+        # whatever order the documents finish in
+        results = [None] * len(file_urls)
+        finished = [False] * len(file_urls)
+        # Finished results in input order, waiting for a full batch
+        ready = []
+        next_slot = 0
+        pushed = 0
+        push_lock = asyncio.Lock()
+        
+        async def push_ready(final: bool = False):
+            """Push finished results as soon as a full batch is ready in input order
+            
+            Saving as the run goes means a timeout or abort keeps what was
+            already done; final pushes whatever is left.
+            """
+            nonlocal next_slot, pushed
+            async with push_lock:
+                while next_slot < len(file_urls) and finished[next_slot]:
+                    if results[next_slot] is not None:
+                        ready.append(results[next_slot])
+                        results[next_slot] = None
+                    next_slot += 1
                 
-                # Save PDF to key-value store
-                if exports.get('pdf'):
-                    pdf_key = f"{file_data['file_id']}_study_guide.pdf"
-                    await Actor.set_value(pdf_key, exports['pdf'], content_type='application/pdf')
-                    Actor.log.info(f'PDF saved to key-value store: {pdf_key}')
-                    pdf_url = f"https://api.apify.com/v2/key-value-stores/{Actor.get_env().get('default_key_value_store_id')}/records/{pdf_key}"
-                else:
-                    pdf_url = None
-                    pdf_key = None
+                while len(ready) >= PUSH_BATCH_SIZE or (final and ready):
+                    batch = ready[:PUSH_BATCH_SIZE]
+                    await Actor.push_data(batch)
+                    del ready[:len(batch)]
+                    pushed += len(batch)
+                    Actor.log.info(f'Pushed {pushed} result(s) to dataset')
+        
+        async def process_document(idx: int, file_url: str):
+            async with semaphore:
+                processed_at = datetime.utcnow().isoformat() + 'Z'
                 
-                # Prepare dataset output
-                result = {
-                    'fileId': file_data['file_id'],
-                    'filename': file_data['filename'],
-                    'sourceUrl': file_url,
-                    'format': file_data['format'],
-                    'processedAt': datetime.utcnow().isoformat() + 'Z',
+                try:
+                    Actor.log.info(f'[{idx}/{len(file_urls)}] Processing: {file_url}')
                     
-                    'studyMaterials': study_materials,
+                    # Download and extract text from document
+                    Actor.log.info('Downloading document...')
+                    file_data = await doc_processor.download_file(file_url)
                     
-                    'exports': {
-                        'ankiCsv': exports.get('anki_csv'),
-                        'notionMarkdown': exports.get('notion_md'),
-                        'quizHtml': exports.get('quiz_html'),
-                        'json': exports.get('json')
-                    },
+                    Actor.log.info(f'Extracting text from {file_data["format"]}...')
+                    extracted_text = await doc_processor.extract_text(
+                        file_data['content'],
+                        file_data['format'],
+                        file_id=file_data['file_id']
+                    )
                     
-                    'pdfUrl': pdf_url,
-                    'pdfKey': pdf_key,
+                    # The length check alone rejects short texts before strip() runs
+                    if (not extracted_text or len(extracted_text) < 100
+                            or len(extracted_text.strip()) < 100):
+                        Actor.log.warning(f'Insufficient text extracted from {file_url}')
+                        return
                     
-                    'statistics': {
-                        'textLength': len(extracted_text),
-                        'wordCount': len(extracted_text.split()),
-                        'estimatedReadTime': f"{len(extracted_text.split()) // 200}m",
-                        'generatedFormats': output_formats,
-                        'flashcardCount': len(study_materials.get('flashcards', [])),
-                        'quizQuestionCount': len(study_materials.get('quiz', {}).get('questions', []))
-                    },
+                    text_length = len(extracted_text)
+                    word_count = len(extracted_text.split())
+                    Actor.log.info(f'Extracted {text_length} characters')
                     
-                    'status': 'success'
-                }
-                
-                # Push to dataset
-                await Actor.push_data(result)
-                Actor.log.info(f'✓ Successfully processed {file_data["filename"]}')
-                
-            except Exception as e:
-                Actor.log.error(f'Error processing {file_url}: {str(e)}')
-                await Actor.push_data({
-                    'sourceUrl': file_url,
-                    'status': 'failed',
-                    'error': str(e),
-                    'processedAt': datetime.utcnow().isoformat() + 'Z'
-                })
+                    # Generate study materials
+                    Actor.log.info('Generating study materials with AI...')
+                    study_materials = await study_gen.generate_materials(
+                        text=extracted_text,
+                        metadata={
+                            'source_url': file_url,
+                            'filename': file_data['filename'],
+                            'format': file_data['format']
+                        },
+                        formats=output_formats,
+                        num_flashcards=num_flashcards,
+                        num_quiz_questions=num_quiz_questions,
+                        difficulty=difficulty_level
+                    )
+                    
+                    # Generate exports
+                    # ReportLab rendering is CPU-bound; keep it off the event loop
+                    Actor.log.info('Creating export formats...')
+                    exports = await asyncio.to_thread(
+                        export_mgr.create_exports,
+                        study_materials=study_materials,
+                        metadata={
+                            'filename': file_data['filename'],
+                            'source_url': file_url,
+                            'processed_at': processed_at
+                        },
+                        formats=export_formats
+                    )
+                    
+                    # Save PDF to key-value store
+                    if exports.get('pdf'):
+                        pdf_key = f"{file_data['file_id']}_study_guide.pdf"
+                        await Actor.set_value(pdf_key, exports['pdf'], content_type='application/pdf')
+                        Actor.log.info(f'PDF saved to key-value store: {pdf_key}')
+                        pdf_url = f"https://api.apify.com/v2/key-value-stores/{Actor.get_env().get('default_key_value_store_id')}/records/{pdf_key}"
+                    else:
+                        pdf_url = None
+                        pdf_key = None
+                    
+                    # Prepare dataset output
+                    result = {
+                        'fileId': file_data['file_id'],
+                        'filename': file_data['filename'],
+                        'sourceUrl': file_url,
+                        'format': file_data['format'],
+                        'processedAt': processed_at,
+                        
+                        'studyMaterials': study_materials,
+                        
+                        'exports': {
+                            'ankiCsv': exports.get('anki_csv'),
+                            'notionMarkdown': exports.get('notion_md'),
+                            'quizHtml': exports.get('quiz_html'),
+                            'json': exports.get('json')
+                        },
+                        
+                        'pdfUrl': pdf_url,
+                        'pdfKey': pdf_key,
+                        
+                        'statistics': {
+                            'textLength': text_length,
+                            'wordCount': word_count,
+                            'estimatedReadTime': f"{word_count // 200}m",
+                            'generatedFormats': output_formats,
+                            'flashcardCount': len(study_materials.get('flashcards', [])),
+                            'quizQuestionCount': len(study_materials.get('quiz', {}).get('questions', []))
+                        },
+                        
+                        'status': 'success'
+                    }
+                    
+                    results[idx - 1] = result
+                    Actor.log.info(f'✓ Successfully processed {file_data["filename"]}')
+                    
+                except Exception as e:
+                    Actor.log.error(f'Error processing {file_url}: {str(e)}')
+                    results[idx - 1] = {
+                        'sourceUrl': file_url,
+                        'status': 'failed',
+                        'error': str(e),
+                        'processedAt': processed_at
+                    }
+        
+        async def process_and_push(idx: int, file_url: str):
+            try:
+                await process_document(idx, file_url)
+            finally:
+                finished[idx - 1] = True
+                await push_ready()
+        
+        # Process documents concurrently; each one handles its own errors.
+        # Results go to the dataset in batches rather than one request per
+        # document; documents skipped for too little text leave their slot empty
+        outcomes = await asyncio.gather(
+            *(process_and_push(idx, file_url) for idx, file_url in enumerate(file_urls, 1)),
+            return_exceptions=True
+        )
+        for outcome in outcomes:
+            if isinstance(outcome, BaseException):
+                Actor.log.error(f'Pushing results failed: {outcome!r}')
         
-        # Clean up
-        await doc_processor.close()
+        try:
+            # Retries anything a failed push left behind; a failure here fails the run
+            await push_ready(final=True)
+        finally:
+            # Clean up
+            await doc_processor.close()
+            await study_gen.close()
+            await close_clients()
         
         Actor.log.info('All documents processed successfully!')
 
 
 if __name__ == '__main__':
-    asyncio.run(main())
\ No newline at end of file
+    # libuv's event loop where available; the stdlib loop otherwise
+    if uvloop is not None:
+        uvloop.run(main())
+    else:
+        asyncio.run(main())
\ No newline at end of file
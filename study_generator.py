@@ -1,112 +1,243 @@
 # Study Material Generator - Uses Claude AI to generate study materials
 
+import asyncio
+import hashlib
+import logging
 import os
 import json
+import math
+import random
 import re
+import sqlite3
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from pathlib import Path
 from typing import Dict, List, Any
 import anthropic
+import httpx
+import jinja2
 
-
-class StudyMaterialGenerator:
-    """Generate study materials using Claude Sonnet"""
+try:
+    import orjson
     
-    def __init__(self, user_api_key: str = None):
-        api_key = user_api_key or os.environ.get('ANTHROPIC_API_KEY')
-        
-        if not api_key:
-            raise ValueError("No Claude API key available")
-        
-        self.client = anthropic.Anthropic(api_key=api_key)
-        self.using_user_key = bool(user_api_key)
+    def _loads(data) -> Any:
+        return orjson.loads(data)
     
-    async def generate_materials(
-        self,
-        text: str,
-        metadata: Dict[str, Any],
-        formats: List[str],
-        num_flashcards: int = 30,
-        num_quiz_questions: int = 20,
-        difficulty: str = 'mixed'
-    ) -> Dict[str, Any]:
-        materials = {}
-        
-        if 'summary' in formats:
-            materials['summary'] = await self._generate_summary(text, metadata)
-        
-        if 'cornellNotes' in formats:
-            materials['cornellNotes'] = await self._generate_cornell_notes(text, metadata)
-        
-        if 'flashcards' in formats:
-            materials['flashcards'] = await self._generate_flashcards(
-                text, metadata, num_flashcards, difficulty
-            )
-        
-        if 'quiz' in formats:
-            materials['quiz'] = await self._generate_quiz(
-                text, metadata, num_quiz_questions, difficulty
-            )
-        
-        if 'mindMap' in formats:
-            materials['mindMap'] = await self._generate_mind_map(text, metadata)
-        
-        return materials
+    def _dumps(data) -> str:
+        return orjson.dumps(data).decode()
+except ImportError:
+    def _loads(data) -> Any:
+        return json.loads(data)
     
-    def _call_claude(self, system: str, user_prompt: str, max_tokens: int = 4000) -> str:
-        message = self.client.messages.create(
-            model="claude-sonnet-4-20250514",
-            max_tokens=max_tokens,
-            system=system,
-            messages=[{
-                "role": "user",
-                "content": user_prompt
-            }]
+    def _dumps(data) -> str:
+        return json.dumps(data)
+
+
+logger = logging.getLogger(__name__)
+# One JSON record per API call: latency, token usage and prompt-cache hits
+perf_logger = logging.getLogger(f'{__name__}.perf')
+
+# API clients by key, shared by every generator so later runs and documents
+# reuse warm keep-alive connections instead of building a new pool each time
+_CLIENTS: Dict[str, anthropic.AsyncAnthropic] = {}
+# In-flight request limits by key, so concurrent documents share one cap
+_LIMITS: Dict[str, asyncio.Semaphore] = {}
+
+
+def _get_client(api_key: str) -> anthropic.AsyncAnthropic:
+    client = _CLIENTS.get(api_key)
+    if client is None or client.is_closed():
+        # Retries are handled in StudyMaterialGenerator._call_llm. HTTP/2
+        # multiplexes the concurrent format requests over one connection
+        # instead of opening (and TLS-handshaking) one per request.
+        client = anthropic.AsyncAnthropic(
+            api_key=api_key,
+            max_retries=0,
+            http_client=anthropic.DefaultAsyncHttpxClient(
+                http2=True,
+                limits=httpx.Limits(max_connections=64, max_keepalive_connections=32, keepalive_expiry=75)
+            )
         )
-        
-        return message.content[0].text
-    
-    async def _generate_summary(self, text: str, metadata: Dict) -> Dict:
-        system = "You are an expert academic writer who creates insightful, comprehensive summaries that capture both the main ideas and important nuances of educational content."
-        
-        prompt = f"""Analyze this document and create a professional executive summary.
+        _CLIENTS[api_key] = client
+    return client
 
-Document: {metadata.get('filename', 'Unknown')}
 
-Full Text:
-{text[:20000]}
+def _get_limit(api_key: str, size: int) -> asyncio.Semaphore:
+    limit = _LIMITS.get(api_key)
+    if limit is None:
+        limit = _LIMITS[api_key] = asyncio.Semaphore(size)
+    return limit
+
+
+async def close_clients():
+    """Close every pooled API client (call once, at shutdown)"""
+    clients = list(_CLIENTS.values())
+    _CLIENTS.clear()
+    _LIMITS.clear()
+    for client in clients:
+        await client.close()
+
+
+# Markdown fences the model sometimes wraps its output in
+_RE_JSON_FENCE_OPEN = re.compile(r'^```(?:json)?[ \t]*\n?')
+_RE_MERMAID_FENCE_OPEN = re.compile(r'^```(?:mermaid)?[ \t]*\n?')
+_RE_FENCE_CLOSE = re.compile(r'\n?```\s*$')
+_RE_TERM = re.compile(r'[^\W\d_]{4,}')
+
+
+# Tool schemas for the structured formats. Forcing the model to "call" the
+# tool makes the API return the arguments as parsed JSON, with no fences or
+# surrounding prose to strip.
+_SUMMARY_TOOL = {
+    'name': 'record_summary',
+    'description': 'Record the executive summary of the document.',
+    'input_schema': {
+        'type': 'object',
+        'properties': {
+            'overview': {
+                'type': 'string',
+                'description': '3-4 sentences explaining what this document is about, its main purpose, and central thesis'
+            },
+            'keyPoints': {
+                'type': 'array',
+                'items': {
+                    'type': 'object',
+                    'properties': {
+                        'point': {'type': 'string', 'description': 'A major concept or finding'},
+                        'details': {
+                            'type': 'string',
+                            'description': '2-3 sentences with specific information, examples, or evidence from the text'
+                        }
+                    },
+                    'required': ['point', 'details']
+                }
+            },
+            'conclusion': {
+                'type': 'string',
+                'description': '2-3 sentences synthesizing how the key points connect and what the main takeaway is'
+            }
+        },
+        'required': ['overview', 'keyPoints', 'conclusion']
+    }
+}
+
+_CORNELL_NOTES_TOOL = {
+    'name': 'record_cornell_notes',
+    'description': 'Record Cornell notes: matching cue and note lists plus a summary.',
+    'input_schema': {
+        'type': 'object',
+        'properties': {
+            'cues': {
+                'type': 'array',
+                'items': {'type': 'string'},
+                'description': 'Specific questions, e.g. "How does X relate to Y?"'
+            },
+            'notes': {
+                'type': 'array',
+                'items': {'type': 'string'},
+                'description': 'Detailed 2-4 sentence answers with examples, one per cue and in the same order'
+            },
+            'summary': {
+                'type': 'string',
+                'description': 'A 4-6 sentence synthesis explaining what this covers, main concepts, and key insights'
+            }
+        },
+        'required': ['cues', 'notes', 'summary']
+    }
+}
+
+_FLASHCARDS_TOOL = {
+    'name': 'record_flashcards',
+    'description': 'Record the flashcards.',
+    'input_schema': {
+        'type': 'object',
+        'properties': {
+            'cards': {
+                'type': 'array',
+                'items': {
+                    'type': 'object',
+                    'properties': {
+                        'front': {'type': 'string', 'description': 'Precise, specific question'},
+                        'back': {'type': 'string', 'description': 'Clear answer in 1-3 sentences'},
+                        'difficulty': {'type': 'string', 'enum': ['easy', 'medium', 'hard']},
+                        'tags': {
+                            'type': 'array',
+                            'items': {'type': 'string'},
+                            'description': 'Topic and subtopic'
+                        }
+                    },
+                    'required': ['front', 'back', 'difficulty', 'tags']
+                }
+            }
+        },
+        'required': ['cards']
+    }
+}
+
+_QUIZ_TOOL = {
+    'name': 'record_quiz',
+    'description': 'Record the multiple-choice quiz questions.',
+    'input_schema': {
+        'type': 'object',
+        'properties': {
+            'questions': {
+                'type': 'array',
+                'items': {
+                    'type': 'object',
+                    'properties': {
+                        'type': {'type': 'string', 'enum': ['multiple_choice']},
+                        'question': {'type': 'string', 'description': 'Clear, specific question'},
+                        'options': {
+                            'type': 'array',
+                            'items': {'type': 'string'},
+                            'minItems': 4,
+                            'maxItems': 4,
+                            'description': 'Lettered options: "A) ...", "B) ...", "C) ...", "D) ..."'
+                        },
+                        'correctAnswer': {'type': 'string', 'enum': ['A', 'B', 'C', 'D']},
+                        'explanation': {
+                            'type': 'string',
+                            'description': 'Why the correct answer is right and why each other option is wrong'
+                        },
+                        'difficulty': {'type': 'string', 'enum': ['easy', 'medium', 'hard']}
+                    },
+                    'required': ['question', 'options', 'correctAnswer', 'explanation']
+                }
+            }
+        },
+        'required': ['questions']
+    }
+}
+
+# Sent with every request in this order, keeping the cached prefix identical
+_TOOLS = [_SUMMARY_TOOL, _CORNELL_NOTES_TOOL, _FLASHCARDS_TOOL, _QUIZ_TOOL]
+
+# Fields a finished material needs before it is cached (other formats just
+# need to be non-empty)
+_REQUIRED_MATERIAL_FIELDS = {
+    'summary': _SUMMARY_TOOL['input_schema']['required'],
+    'cornellNotes': _CORNELL_NOTES_TOOL['input_schema']['required'],
+    'quiz': ['questions']
+}
+
+# User prompts: the format's persona and instructions (the document itself is
+# in the shared system prompt). The per-item ones are templates compiled once.
+_PROMPTS = jinja2.Environment(autoescape=False)
+
+_SUMMARY_PROMPT = """You are an expert academic writer who creates insightful, comprehensive summaries that capture both the main ideas and important nuances of educational content.
+
+Analyze this document and create a professional executive summary.
 
 Create a comprehensive summary that:
 1. Captures the document's main purpose and central argument
 2. Identifies 5-8 key points with specific details and examples
-3. Provides a meaningful conclusion that synthesizes the content
-
-Return ONLY valid JSON (no markdown, no backticks):
-{{
-    "overview": "3-4 sentences explaining what this document is about, its main purpose, and central thesis",
-    "keyPoints": [
-        {{
-            "point": "First major concept or finding",
-            "details": "2-3 sentences with specific information, examples, or evidence from the text"
-        }},
-        {{
-            "point": "Second major concept",
-            "details": "Concrete details and context"
-        }}
-    ],
-    "conclusion": "2-3 sentences synthesizing how the key points connect and what the main takeaway is"
-}}"""
-        
-        response = self._call_claude(system, prompt, max_tokens=3000)
-        return self._parse_json_response(response)
-    
-    async def _generate_cornell_notes(self, text: str, metadata: Dict) -> Dict:
-        system = "You are a master educator who creates exceptional Cornell Notes. Your notes are detailed, well-organized, and optimized for learning and retention."
-        
-        prompt = f"""Create comprehensive Cornell Notes from this document.
+3. Provides a meaningful conclusion that synthesizes the content"""
 
-Document: {metadata.get('filename', 'Unknown')}
+_CORNELL_NOTES_PROMPT = """You are a master educator who creates exceptional Cornell Notes. Your notes are detailed, well-organized, and optimized for learning and retention.
 
-Full Text:
-{text[:20000]}
+Create comprehensive Cornell Notes from this document.
 
 CORNELL NOTES FORMAT:
 - Cues: Specific questions that test understanding
@@ -117,97 +248,34 @@ REQUIREMENTS:
 - Create 15-20 high-quality cue-note pairs
 - Questions should be specific and meaningful
 - Notes should be detailed with concrete information
-- Include examples and explanations
-
-Return ONLY valid JSON:
-{{
-    "cues": ["Specific question about first major concept?", "How does X relate to Y?"],
-    "notes": ["Detailed answer with 2-4 sentences including examples.", "Another comprehensive answer."],
-    "summary": "A 4-6 sentence synthesis explaining what this covers, main concepts, and key insights."
-}}"""
-        
-        response = self._call_claude(system, prompt, max_tokens=5000)
-        return self._parse_json_response(response)
-    
-    async def _generate_flashcards(self, text: str, metadata: Dict, num_cards: int, difficulty: str) -> List[Dict]:
-        system = "You are an expert at creating highly effective flashcards for spaced repetition learning."
-        
-        difficulty_guidance = {
-            'easy': 'Focus on fundamental facts and definitions',
-            'medium': 'Balance factual recall with conceptual understanding',
-            'hard': 'Emphasize complex concepts and application',
-            'mixed': 'Create a balanced mix: 40% easy, 40% medium, 20% hard'
-        }
-        
-        prompt = f"""Create {num_cards} high-quality flashcards from this document.
+- Include examples and explanations"""
 
-Document: {metadata.get('filename', 'Unknown')}
-Difficulty: {difficulty} - {difficulty_guidance.get(difficulty, '')}
+_FLASHCARDS_PROMPT = _PROMPTS.from_string("""You are an expert at creating highly effective flashcards for spaced repetition learning.
 
-Full Text:
-{text[:20000]}
+Create {{ count }} high-quality flashcards from this document.
+
+Difficulty: {{ difficulty }} - {{ guidance }}
 
 FLASHCARD BEST PRACTICES:
 - Each card tests ONE specific concept
 - Front: Clear, specific question
 - Back: Concise answer (1-3 sentences)
-- Test understanding, not just memorization
+- Test understanding, not just memorization""")
 
-Return ONLY valid JSON array:
-[
-    {{
-        "front": "Precise, specific question",
-        "back": "Clear answer in 1-3 sentences",
-        "difficulty": "easy|medium|hard",
-        "tags": ["topic", "subtopic"]
-    }}
-]"""
-        
-        response = self._call_claude(system, prompt, max_tokens=6000)
-        return self._parse_json_response(response)
-    
-    async def _generate_quiz(self, text: str, metadata: Dict, num_questions: int, difficulty: str) -> Dict:
-        system = "You are an expert assessment designer who creates fair, well-crafted multiple-choice questions."
-        
-        prompt = f"""Create a {num_questions}-question multiple-choice quiz from this document.
+_QUIZ_PROMPT = _PROMPTS.from_string("""You are an expert assessment designer who creates fair, well-crafted multiple-choice questions.
 
-Document: {metadata.get('filename', 'Unknown')}
-Difficulty: {difficulty}
+Create a {{ count }}-question multiple-choice quiz from this document.
 
-Full Text:
-{text[:20000]}
+Difficulty: {{ difficulty }}
 
 REQUIREMENTS:
 - All 4 options should be plausible
 - Explanations should teach why correct answer is right AND why others are wrong
-- Cover different concepts
-
-Return ONLY valid JSON:
-{{
-    "questions": [
-        {{
-            "type": "multiple_choice",
-            "question": "Clear, specific question",
-            "options": ["A) First option", "B) Second option", "C) Third option", "D) Fourth option"],
-            "correctAnswer": "A",
-            "explanation": "A is correct because [reason]. B is incorrect because [reason].",
-            "difficulty": "easy|medium|hard"
-        }}
-    ]
-}}"""
-        
-        response = self._call_claude(system, prompt, max_tokens=6000)
-        return self._parse_json_response(response)
-    
-    async def _generate_mind_map(self, text: str, metadata: Dict) -> str:
-        system = "You are an expert at creating clear mind maps using Mermaid syntax."
-        
-        prompt = f"""Create a Mermaid mind map from this document.
+- Cover different concepts""")
 
-Document: {metadata.get('filename', 'Unknown')}
+_MIND_MAP_PROMPT = """You are an expert at creating clear mind maps using Mermaid syntax.
 
-Text:
-{text[:15000]}
+Create a Mermaid mind map from this document.
 
 REQUIREMENTS:
 - 4-6 main branches (major concepts)
@@ -221,23 +289,738 @@ mindmap
     Major Concept 1
       Detail A
       Detail B"""
+
+_DIFFICULTY_GUIDANCE = {
+    'easy': 'Focus on fundamental facts and definitions',
+    'medium': 'Balance factual recall with conceptual understanding',
+    'hard': 'Emphasize complex concepts and application',
+    'mixed': 'Create a balanced mix: 40% easy, 40% medium, 20% hard'
+}
+
+
+def _iter_json_blobs(text: str):
+    """Yield each balanced top-level {...} or [...] span in text
+    
+    One linear pass tracking bracket depth and string state, so braces
+    inside JSON strings are ignored and trailing prose is never included.
+    """
+    depth = 0
+    start = 0
+    in_string = False
+    escaped = False
+    
+    for i, char in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char in '{[':
+            if depth == 0:
+                start = i
+            depth += 1
+        elif char in '}]':
+            if depth:
+                depth -= 1
+                if depth == 0:
+                    yield text[start:i + 1]
+        elif char == '"' and depth:
+            in_string = True
+
+
+class TruncatedReplyError(ValueError):
+    """A structured reply stopped at max_tokens, so its tool input is partial"""
+
+
+class StudyMaterialGenerator:
+    """Generate study materials using Claude Sonnet (Haiku for the lighter formats)"""
+    
+    MODEL = "claude-sonnet-4-20250514"
+    # Formats that do not need Sonnet; the rest use MODEL
+    FORMAT_MODELS = {
+        'summary': "claude-haiku-4-5",
+        'cornellNotes': "claude-haiku-4-5",
+        'mindMap': "claude-haiku-4-5"
+    }
+    RESPONSE_CACHE_MAX_ENTRIES = 256
+    # Prompt window; flashcards and quizzes for longer documents are
+    # generated per window, the other formats share one excerpt of the most
+    # informative passages (one excerpt, so their prompts share the cached
+    # document prefix)
+    CHUNK_CHARS = 20000
+    CHUNK_OVERLAP = 500
+    MAX_CHUNKS = 4
+    # Excerpt selection: passage size and number of query terms
+    PASSAGE_CHARS = 1000
+    EXCERPT_QUERY_TERMS = 64
+    # Output budgets for the per-item formats, sized from the requested count
+    FLASHCARD_TOKENS = 150
+    QUIZ_QUESTION_TOKENS = 250
+    BASE_OUTPUT_TOKENS = 300
+    MAX_OUTPUT_TOKENS = 16000
+    # Transient API failures are retried with full-jitter exponential backoff
+    RETRY_ATTEMPTS = 4
+    RETRY_BASE_DELAY = 1.0
+    RETRY_MAX_DELAY = 30.0
+    # Seconds between status checks while a message batch is processing
+    BATCH_POLL_INTERVAL = 30.0
+    # Requests in flight at once per API key, across all documents; more
+    # than this mostly buys 429s
+    MAX_CONCURRENT_CALLS = 8
+    # Finished materials persist here across runs (shared with DocumentProcessor)
+    CACHE_DIR = Path.home() / '.cache' / 'lumina-pdf'
+    MATERIALS_CACHE_TTL = 30 * 24 * 3600
+    # Bump when post-processing (merging, cleanup) changes; prompt, schema
+    # and model changes already change the key
+    MATERIALS_CACHE_VERSION = 2
+    
+    def __init__(self, user_api_key: str = None):
+        api_key = user_api_key or os.environ.get('ANTHROPIC_API_KEY')
+        
+        if not api_key:
+            raise ValueError("No Claude API key available")
+        
+        self.client = _get_client(api_key)
+        self._limit = _get_limit(api_key, self.MAX_CONCURRENT_CALLS)
+        self.using_user_key = bool(user_api_key)
+        
+        # Identical requests (same document, prompt and limits) reuse the
+        # earlier response instead of calling the API again
+        self._response_cache = OrderedDict()
+        # Document prompts being sent to the API, by _prefix_key (see
+        # _call_claude); dropped once the document's requests are done
+        self._primed_prefixes = {}
+        self._cache_executor = ThreadPoolExecutor(max_workers=1)
+        self._materials_db = None
+        self._materials_db_opened = False
+    
+    async def generate_materials(
+        self,
+        text: str,
+        metadata: Dict[str, Any],
+        formats: List[str],
+        num_flashcards: int = 30,
+        num_quiz_questions: int = 20,
+        difficulty: str = 'mixed',
+        model_overrides: Dict[str, str] = None
+    ) -> Dict[str, Any]:
+        """model_overrides maps format names to models, replacing FORMAT_MODELS"""
+        plan = self._plan(text, metadata, formats, num_flashcards, num_quiz_questions,
+                          difficulty, model_overrides)
+        cache_keys = self._material_keys(text, plan, num_flashcards, num_quiz_questions, difficulty)
+        
+        found = await self._in_cache_thread(self._get_cached_materials, cache_keys)
+        pending = [key for key in plan if key not in found]
+        
+        # Each format is independent, so all of them (and all of their
+        # per-window requests) run concurrently
+        try:
+            results = await asyncio.gather(
+                *(self._run(*plan[key]) for key in pending),
+                return_exceptions=True
+            )
+        finally:
+            for key in pending:
+                for request in plan[key][0]:
+                    self._primed_prefixes.pop(self._prefix_key(request['model'], request['system']), None)
+        
+        # A failed format is left out rather than failing the whole document,
+        # unless nothing could be generated at all
+        errors = []
+        to_store = {}
+        for key, result in zip(pending, results):
+            if isinstance(result, Exception):
+                logger.warning(f'Failed to generate {key}: {result}')
+                errors.append(result)
+            else:
+                found[key] = result
+                if self._is_complete(key, result):
+                    to_store[cache_keys[key]] = result
+        await self._in_cache_thread(self._set_cached_materials, to_store)
+        
+        if errors and not found:
+            raise errors[0]
         
-        response = self._call_claude(system, prompt, max_tokens=2000)
-        mermaid_code = response.strip()
-        mermaid_code = re.sub(r'```mermaid\n?', '', mermaid_code)
-        mermaid_code = re.sub(r'```\n?', '', mermaid_code)
-        return mermaid_code.strip()
+        return {key: found[key] for key in plan if key in found}
+    
+    async def generate_materials_batch(
+        self,
+        documents: List[tuple],
+        formats: List[str],
+        num_flashcards: int = 30,
+        num_quiz_questions: int = 20,
+        difficulty: str = 'mixed',
+        model_overrides: Dict[str, str] = None
+    ) -> List[Dict[str, Any]]:
+        """Generate materials for many documents through the Message Batches API
+        
+        documents is a list of (text, metadata) pairs; one materials dict is
+        returned per document, in order. Batched requests cost half as much
+        as generate_materials but complete asynchronously (usually within an
+        hour, at most a day), so this is meant for bulk jobs.
+        """
+        plans = []
+        all_materials = []
+        all_keys = []
+        for text, metadata in documents:
+            plan = self._plan(text, metadata, formats, num_flashcards, num_quiz_questions,
+                              difficulty, model_overrides)
+            cache_keys = self._material_keys(text, plan, num_flashcards, num_quiz_questions, difficulty)
+            materials = await self._in_cache_thread(self._get_cached_materials, cache_keys)
+            for key in materials:
+                del plan[key]
+            plans.append(plan)
+            all_materials.append(materials)
+            all_keys.append(cache_keys)
+        
+        batch_requests = []
+        tools = {}
+        for doc_index, plan in enumerate(plans):
+            for key, (requests, _) in plan.items():
+                for part, request in enumerate(requests):
+                    custom_id = f'{doc_index}-{key}-{part}'
+                    tools[custom_id] = request['tool']
+                    batch_requests.append({
+                        'custom_id': custom_id,
+                        'params': self._request_params(**request)
+                    })
+        
+        if not batch_requests:
+            return all_materials
+        
+        batch = await self.client.messages.batches.create(requests=batch_requests)
+        while batch.processing_status != 'ended':
+            await asyncio.sleep(self.BATCH_POLL_INTERVAL)
+            batch = await self.client.messages.batches.retrieve(batch.id)
+        
+        replies = {}
+        async for entry in await self.client.messages.batches.results(batch.id):
+            if entry.result.type == 'succeeded':
+                replies[entry.custom_id] = entry.result.message
+            else:
+                logger.warning(f'Batch request {entry.custom_id} {entry.result.type}')
+        
+        to_store = {}
+        for doc_index, plan in enumerate(plans):
+            materials = all_materials[doc_index]
+            for key, (requests, finish) in plan.items():
+                ids = [f'{doc_index}-{key}-{part}' for part in range(len(requests))]
+                try:
+                    materials[key] = finish([
+                        self._message_result(replies[custom_id], tools[custom_id])
+                        for custom_id in ids
+                    ])
+                except Exception as e:
+                    # One bad reply must not throw away the rest of a paid-for batch
+                    logger.warning(f'Failed to generate {key} for document {doc_index}: {e!r}')
+                else:
+                    if self._is_complete(key, materials[key]):
+                        to_store[all_keys[doc_index][key]] = materials[key]
+        
+        await self._in_cache_thread(self._set_cached_materials, to_store)
+        return all_materials
+    
+    def _plan(self, text: str, metadata: Dict[str, Any], formats: List[str],
+              num_flashcards: int, num_quiz_questions: int, difficulty: str,
+              model_overrides: Dict[str, str] = None) -> Dict[str, tuple]:
+        """Map each requested format to (requests, finish)
+        
+        requests are _call_llm keyword arguments; finish turns their results,
+        in order, into the format's material.
+        """
+        # Selected once and shared by every single-window format
+        excerpt = self._select_excerpt(text)
+        plan = {}
+        
+        if 'summary' in formats:
+            plan['summary'] = ([self._summary_request(excerpt, metadata)], self._first)
+        
+        if 'cornellNotes' in formats:
+            plan['cornellNotes'] = ([self._cornell_notes_request(excerpt, metadata)], self._first)
+        
+        if 'flashcards' in formats:
+            plan['flashcards'] = (
+                self._flashcard_requests(text, metadata, num_flashcards, difficulty),
+                partial(self._merge_flashcards, limit=num_flashcards)
+            )
+        
+        if 'quiz' in formats:
+            plan['quiz'] = (
+                self._quiz_requests(text, metadata, num_quiz_questions, difficulty),
+                partial(self._merge_quiz, limit=num_quiz_questions)
+            )
+        
+        if 'mindMap' in formats:
+            plan['mindMap'] = (
+                [self._mind_map_request(excerpt, metadata)],
+                self._clean_mind_map
+            )
+        
+        models = {**self.FORMAT_MODELS, **(model_overrides or {})}
+        for key, (requests, _) in plan.items():
+            for request in requests:
+                request['model'] = models.get(key, self.MODEL)
+        
+        return plan
+    
+    def _material_keys(self, text: str, plan: Dict[str, tuple], num_flashcards: int,
+                       num_quiz_questions: int, difficulty: str) -> Dict[str, str]:
+        """Persistent cache key per format
+        
+        Covers the document and everything its requests send (prompts, tool
+        schema, model, budgets) plus the options applied afterwards, so a
+        change to any of them misses instead of serving stale output.
+        """
+        doc_hash = hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+        options = {
+            'flashcards': [num_flashcards, difficulty],
+            'quiz': [num_quiz_questions, difficulty]
+        }
+        keys = {}
+        for key, (requests, _) in plan.items():
+            version = _dumps([self.MATERIALS_CACHE_VERSION, options.get(key), requests])
+            keys[key] = f"{doc_hash}:{key}:{hashlib.blake2b(version.encode(), digest_size=16).hexdigest()}"
+        return keys
+    
+    @staticmethod
+    def _is_complete(key: str, material: Any) -> bool:
+        """Whether a generated material is whole enough to cache"""
+        required = _REQUIRED_MATERIAL_FIELDS.get(key)
+        if required:
+            return isinstance(material, dict) and all(material.get(name) for name in required)
+        return bool(material)
+    
+    def _open_materials_cache(self):
+        """Open (creating if needed) the on-disk materials cache; None if unavailable"""
+        try:
+            self.CACHE_DIR.mkdir(parents=True, exist_ok=True)
+            db = sqlite3.connect(self.CACHE_DIR / 'materials.sqlite3')
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS materials '
+                '(key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL)'
+            )
+            with db:
+                db.execute(
+                    'DELETE FROM materials WHERE created_at < ?',
+                    (time.time() - self.MATERIALS_CACHE_TTL,)
+                )
+            return db
+        except (OSError, sqlite3.Error):
+            return None
+    
+    def _materials_cache(self):
+        """The cache connection, opened on first use (cache thread only)"""
+        if not self._materials_db_opened:
+            self._materials_db_opened = True
+            self._materials_db = self._open_materials_cache()
+        return self._materials_db
+    
+    async def _in_cache_thread(self, func, *args):
+        # SQLite reads and committed writes block, so the connection lives on
+        # a single thread of its own, off the event loop
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._cache_executor, func, *args)
+    
+    def _get_cached_materials(self, keys: Dict[str, str]) -> Dict[str, Any]:
+        """Cached materials for the formats in keys (format -> cache key)"""
+        db = self._materials_cache()
+        if db is None:
+            return {}
+        found = {}
+        try:
+            for name, key in keys.items():
+                row = db.execute(
+                    'SELECT value FROM materials WHERE key = ? AND created_at >= ?',
+                    (key, time.time() - self.MATERIALS_CACHE_TTL)
+                ).fetchone()
+                if row:
+                    found[name] = _loads(row[0])
+        except sqlite3.Error:
+            pass
+        return found
+    
+    def _set_cached_materials(self, items: Dict[str, Any]):
+        """Store cache key -> material pairs in one transaction (best-effort,
+        like DocumentProcessor's disk cache)"""
+        db = self._materials_cache()
+        if db is None or not items:
+            return
+        now = time.time()
+        try:
+            with db:
+                db.executemany(
+                    'INSERT OR REPLACE INTO materials (key, value, created_at) VALUES (?, ?, ?)',
+                    [(key, _dumps(value), now) for key, value in items.items()]
+                )
+        except sqlite3.Error:
+            pass
+    
+    def _close_materials_cache(self):
+        if self._materials_db is not None:
+            self._materials_db.close()
+            self._materials_db = None
+    
+    async def close(self):
+        """Close the materials cache (API clients are closed by close_clients)"""
+        await self._in_cache_thread(self._close_materials_cache)
+        self._cache_executor.shutdown(wait=False)
+    
+    async def _run(self, requests: List[Dict], finish) -> Any:
+        results = await asyncio.gather(*(self._call_llm(**request) for request in requests))
+        return finish(results)
+    
+    async def _call_llm(self, system: str, user_prompt: str, max_tokens: int = 4000,
+                        tool: Dict = None, model: str = None) -> Any:
+        """Single entry point every format generator uses to reach the model
+        
+        A structured reply cut off at max_tokens is asked for once more with
+        twice the budget (up to MAX_OUTPUT_TOKENS) before giving up.
+        """
+        try:
+            return await self._call_with_retries(system, user_prompt, max_tokens, tool, model)
+        except TruncatedReplyError as e:
+            if max_tokens >= self.MAX_OUTPUT_TOKENS:
+                raise
+            logger.warning(f'{e}; retrying with a larger budget')
+            max_tokens = min(self.MAX_OUTPUT_TOKENS, max_tokens * 2)
+            return await self._call_with_retries(system, user_prompt, max_tokens, tool, model)
+    
+    async def _call_with_retries(self, system: str, user_prompt: str, max_tokens: int,
+                                 tool: Dict = None, model: str = None) -> Any:
+        """_call_claude, retried with jittered backoff on transient API errors"""
+        for attempt in range(1, self.RETRY_ATTEMPTS + 1):
+            try:
+                return await self._call_claude(system, user_prompt, max_tokens, tool, model)
+            except anthropic.APIError as e:
+                if attempt == self.RETRY_ATTEMPTS or not self._is_transient(e):
+                    raise
+                delay = random.uniform(0, min(self.RETRY_MAX_DELAY, self.RETRY_BASE_DELAY * 2 ** attempt))
+                logger.warning(f'Claude call failed ({e}); retrying in {delay:.1f}s '
+                               f'(attempt {attempt}/{self.RETRY_ATTEMPTS})')
+                await asyncio.sleep(delay)
+    
+    @staticmethod
+    def _is_transient(error: Exception) -> bool:
+        """Timeouts, dropped connections, rate limits and server-side errors"""
+        if isinstance(error, anthropic.APIConnectionError):
+            return True
+        status = getattr(error, 'status_code', None)
+        return status in (408, 409, 429) or (status is not None and status >= 500)
+    
+    async def _call_claude(self, system: str, user_prompt: str, max_tokens: int = 4000,
+                           tool: Dict = None, model: str = None) -> Any:
+        """Return the reply text, or with a tool, the tool's parsed input"""
+        cache_key = self._response_cache_key(system, user_prompt, max_tokens, tool, model)
+        cached = self._get_cached_response(cache_key)
+        if cached is not None:
+            return cached
+        
+        request = self._request_params(system, user_prompt, max_tokens, tool, model)
+        
+        # The server-side prompt cache only serves a prefix once a request
+        # has written it, and concurrent requests would each miss and each
+        # pay the write. So the first request per document goes alone and
+        # the rest sharing its prefix wait until it has started. Each model
+        # has its own cache, so the prefix is per model.
+        prefix = self._prefix_key(request['model'], system)
+        primed = self._primed_prefixes.get(prefix)
+        if primed is None:
+            primed = self._primed_prefixes[prefix] = asyncio.Event()
+        else:
+            await primed.wait()
+        
+        try:
+            # Streamed so long generations arrive incrementally over a live
+            # connection instead of one response after the last token
+            async with self._limit:
+                started = time.perf_counter()
+                async with self.client.messages.stream(**request) as stream:
+                    primed.set()
+                    message = await stream.get_final_message()
+                self._log_usage(request, message, time.perf_counter() - started)
+        finally:
+            primed.set()
+        
+        response = self._message_result(message, tool)
+        self._remember_response(cache_key, response)
+        return response
+    
+    @staticmethod
+    def _prefix_key(model: str, system: str) -> tuple:
+        # A digest rather than the prompt itself, which holds the document text
+        return model, hashlib.blake2b(system.encode(), digest_size=16).digest()
+    
+    def _request_params(self, system: str, user_prompt: str, max_tokens: int,
+                        tool: Dict = None, model: str = None) -> Dict[str, Any]:
+        # Tools and system prompt are the same for every format, so together
+        # they form one cacheable prefix; only tool_choice and the user turn
+        # differ (tool_choice changes do not invalidate the system cache)
+        return {
+            'model': model or self.MODEL,
+            'max_tokens': max_tokens,
+            'system': [{
+                'type': 'text',
+                'text': system,
+                'cache_control': {'type': 'ephemeral'}
+            }],
+            'tools': _TOOLS,
+            'tool_choice': {'type': 'tool', 'name': tool['name']} if tool else {'type': 'none'},
+            'messages': [{
+                "role": "user",
+                "content": user_prompt
+            }]
+        }
+    
+    @staticmethod
+    def _log_usage(request: Dict[str, Any], message, seconds: float):
+        usage = message.usage
+        perf_logger.info(_dumps({
+            'model': request['model'],
+            'tool': request['tool_choice'].get('name'),
+            'seconds': round(seconds, 3),
+            'input_tokens': usage.input_tokens,
+            'output_tokens': usage.output_tokens,
+            'cache_read_input_tokens': usage.cache_read_input_tokens or 0,
+            'cache_creation_input_tokens': usage.cache_creation_input_tokens or 0,
+            'stop_reason': message.stop_reason
+        }))
+    
+    def _message_result(self, message, tool: Dict = None) -> Any:
+        if tool is not None and message.stop_reason == 'max_tokens':
+            # The SDK returns whatever partial JSON had arrived, so the last
+            # card or question may be missing fields
+            raise TruncatedReplyError(f"{tool['name']} reply was cut off at max_tokens")
+        
+        if tool is not None:
+            for block in message.content:
+                if block.type == 'tool_use':
+                    return block.input
+        
+        text = ''.join(block.text for block in message.content if block.type == 'text')
+        if tool is not None:
+            # No tool call (should not happen with tool_choice); read JSON from the text
+            return self._parse_json_response(text)
+        return text
+    
+    def _response_cache_key(self, system: str, user_prompt: str, max_tokens: int,
+                            tool: Dict = None, model: str = None) -> str:
+        request = _dumps({
+            'model': model or self.MODEL,
+            'system': system,
+            'user': user_prompt,
+            'max_tokens': max_tokens,
+            'tool': tool['name'] if tool else None
+        })
+        return hashlib.sha256(request.encode()).hexdigest()
+    
+    def _get_cached_response(self, key: str):
+        if key in self._response_cache:
+            self._response_cache.move_to_end(key)
+            return self._response_cache[key]
+        return None
+    
+    def _remember_response(self, key: str, response: Any):
+        self._response_cache[key] = response
+        self._response_cache.move_to_end(key)
+        if len(self._response_cache) > self.RESPONSE_CACHE_MAX_ENTRIES:
+            self._response_cache.popitem(last=False)
+    
+    def _document_system(self, text: str, metadata: Dict) -> str:
+        """System prompt carrying the document, identical for every format"""
+        return f"""You are an expert educator who turns documents into high-quality study materials. Follow the task instructions in each request exactly.
+
+Document: {metadata.get('filename', 'Unknown')}
+
+Full Text:
+{text}"""
+    
+    def _summary_request(self, text: str, metadata: Dict) -> Dict:
+        return self._request(self._document_system(text, metadata), _SUMMARY_PROMPT, 3000, _SUMMARY_TOOL)
+    
+    def _cornell_notes_request(self, text: str, metadata: Dict) -> Dict:
+        return self._request(self._document_system(text, metadata), _CORNELL_NOTES_PROMPT, 5000, _CORNELL_NOTES_TOOL)
+    
+    def _flashcard_requests(self, text: str, metadata: Dict, num_cards: int, difficulty: str) -> List[Dict]:
+        def request(chunk: str, count: int) -> Dict:
+            prompt = _FLASHCARDS_PROMPT.render(
+                count=count,
+                difficulty=difficulty,
+                guidance=_DIFFICULTY_GUIDANCE.get(difficulty, '')
+            )
+            max_tokens = self._output_budget(count, self.FLASHCARD_TOKENS)
+            return self._request(self._document_system(chunk, metadata), prompt, max_tokens, _FLASHCARDS_TOOL)
+        
+        return [request(chunk, count) for chunk, count in self._split_work(text, num_cards)]
+    
+    def _quiz_requests(self, text: str, metadata: Dict, num_questions: int, difficulty: str) -> List[Dict]:
+        def request(chunk: str, count: int) -> Dict:
+            prompt = _QUIZ_PROMPT.render(count=count, difficulty=difficulty)
+            max_tokens = self._output_budget(count, self.QUIZ_QUESTION_TOKENS)
+            return self._request(self._document_system(chunk, metadata), prompt, max_tokens, _QUIZ_TOOL)
+        
+        return [request(chunk, count) for chunk, count in self._split_work(text, num_questions)]
+    
+    def _mind_map_request(self, text: str, metadata: Dict) -> Dict:
+        return self._request(self._document_system(text, metadata), _MIND_MAP_PROMPT, 2000)
+    
+    @staticmethod
+    def _request(system: str, user_prompt: str, max_tokens: int, tool: Dict = None) -> Dict:
+        return {'system': system, 'user_prompt': user_prompt, 'max_tokens': max_tokens, 'tool': tool}
+    
+    @staticmethod
+    def _first(results: List[Any]) -> Any:
+        return results[0]
+    
+    @staticmethod
+    def _reply_items(result: Any, field: str) -> List[Any]:
+        """The item list in a reply: the tool wraps it in an object, the JSON-text fallback may not"""
+        if isinstance(result, list):
+            return result
+        if isinstance(result, dict) and isinstance(result.get(field), list):
+            return result[field]
+        return []
+    
+    def _merge_flashcards(self, results: List[Any], limit: int) -> List[Dict]:
+        batches = [self._reply_items(result, 'cards') for result in results]
+        return self._merge_unique(batches, 'front', limit, ('front', 'back'))
+    
+    def _merge_quiz(self, results: List[Any], limit: int) -> Dict:
+        batches = [self._reply_items(result, 'questions') for result in results]
+        return {'questions': self._merge_unique(batches, 'question', limit,
+                                                ('question', 'options', 'correctAnswer'))}
+    
+    @staticmethod
+    def _clean_mind_map(results: List[str]) -> str:
+        diagram = _RE_MERMAID_FENCE_OPEN.sub('', results[0].strip(), count=1)
+        return _RE_FENCE_CLOSE.sub('', diagram, count=1).strip()
+    
+    def _output_budget(self, count: int, tokens_per_item: int) -> int:
+        """max_tokens for a reply of count items, instead of one fixed cap for any count"""
+        return min(self.MAX_OUTPUT_TOKENS, self.BASE_OUTPUT_TOKENS + count * tokens_per_item)
+    
+    def _split_work(self, text: str, total: int) -> List[tuple]:
+        """Split text into prompt-sized windows and share total items among them
+        
+        Text that fits one window yields a single (text, total) pair, so short
+        documents still make exactly one call. Longer documents are cut into
+        up to MAX_CHUNKS evenly spaced, slightly overlapping windows.
+        """
+        if len(text) <= self.CHUNK_CHARS:
+            return [(text, total)]
+        
+        windows = min(self.MAX_CHUNKS, -(-len(text) // self.CHUNK_CHARS))
+        stride = -(-len(text) // windows)
+        size = min(stride + self.CHUNK_OVERLAP, self.CHUNK_CHARS)
+        chunks = [text[i * stride:i * stride + size] for i in range(windows)]
+        
+        base, extra = divmod(total, len(chunks))
+        work = [(chunk, base + (i < extra)) for i, chunk in enumerate(chunks)]
+        return [(chunk, count) for chunk, count in work if count > 0]
+    
+    def _select_excerpt(self, text: str) -> str:
+        """Up to CHUNK_CHARS of text's most informative passages, in document order
+        
+        Text that fits is returned whole. Otherwise the text is cut into
+        passages of about PASSAGE_CHARS on line boundaries (longer lines are
+        split into passages of their own) and each one is
+        scored with BM25 against the document's own most frequent terms, so
+        the excerpt covers the whole document instead of only its start. The
+        opening passage is always kept, as it usually names the topic.
+        """
+        if len(text) <= self.CHUNK_CHARS:
+            return text
+        
+        passages = []
+        current = []
+        size = 0
+        for line in text.splitlines():
+            while len(line) > self.PASSAGE_CHARS:
+                if current:
+                    passages.append('\n'.join(current))
+                    current = []
+                    size = 0
+                passages.append(line[:self.PASSAGE_CHARS])
+                line = line[self.PASSAGE_CHARS:]
+            current.append(line)
+            size += len(line) + 1
+            if size >= self.PASSAGE_CHARS:
+                passages.append('\n'.join(current))
+                current = []
+                size = 0
+        if current:
+            passages.append('\n'.join(current))
+        
+        terms = [Counter(_RE_TERM.findall(passage.lower())) for passage in passages]
+        totals = Counter()
+        frequency = Counter()
+        for counts in terms:
+            totals.update(counts)
+            frequency.update(counts.keys())
+        
+        n = len(passages)
+        avg_len = sum(sum(counts.values()) for counts in terms) / n or 1
+        query = [
+            (term, math.log(1 + (n - frequency[term] + 0.5) / (frequency[term] + 0.5)))
+            for term, _ in totals.most_common(self.EXCERPT_QUERY_TERMS)
+        ]
+        
+        def score(counts: Counter) -> float:
+            norm = 1.5 * (0.25 + 0.75 * sum(counts.values()) / avg_len)
+            return sum(
+                idf * counts[term] * 2.5 / (counts[term] + norm)
+                for term, idf in query if counts[term]
+            )
+        
+        ranked = sorted(range(1, n), key=lambda i: score(terms[i]), reverse=True)
+        chosen = []
+        budget = self.CHUNK_CHARS
+        for i in [0] + ranked:
+            if len(passages[i]) < budget:
+                chosen.append(i)
+                budget -= len(passages[i]) + 1
+        
+        return '\n'.join(passages[i] for i in sorted(chosen))
+    
+    @staticmethod
+    def _merge_unique(batches: List[List[Dict]], field: str, limit: int,
+                      required: tuple = ()) -> List[Dict]:
+        """Concatenate per-chunk results, dropping repeats from overlapping windows
+        
+        Items missing any of the required fields are dropped too; the
+        exports index those fields directly.
+        """
+        seen = set()
+        merged = []
+        for batch in batches:
+            for item in batch:
+                if not isinstance(item, dict) or not all(item.get(name) for name in required):
+                    continue
+                key = str(item.get(field, '')).strip().lower()
+                if key in seen:
+                    continue
+                seen.add(key)
+                merged.append(item)
+        return merged[:limit]
     
     def _parse_json_response(self, response: str) -> Any:
         response = response.strip()
-        response = re.sub(r'^```json\n?', '', response)
-        response = re.sub(r'^```\n?', '', response)
-        response = re.sub(r'\n?```$', '', response)
+        response = _RE_JSON_FENCE_OPEN.sub('', response, count=1)
+        response = _RE_FENCE_CLOSE.sub('', response, count=1)
         
+        # orjson.JSONDecodeError subclasses json.JSONDecodeError
         try:
-            return json.loads(response)
+            return _loads(response)
         except json.JSONDecodeError as e:
-            json_match = re.search(r'\{.*\}|\[.*\]', response, re.DOTALL)
-            if json_match:
-                return json.loads(json_match.group())
-            raise ValueError(f"Could not parse JSON from response: {e}")
\ No newline at end of file
+            error = e
+        
+        # Fall back to the embedded objects/arrays, largest first: the payload
+        # outweighs any bracketed aside in the surrounding prose
+        for blob in sorted(_iter_json_blobs(response), key=len, reverse=True):
+            try:
+                return _loads(blob)
+            except json.JSONDecodeError:
+                continue
+        raise ValueError(f"Could not parse JSON from response: {error}")
\ No newline at end of file